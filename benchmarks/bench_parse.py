@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Compare parse_a1111_params against the regex cascade it replaced.
+
+The cascade only reads settings that follow a negative prompt, so every
+timed sample has one and both parsers do the same work on it.
+
+Usage: python benchmarks/bench_parse.py [--count N]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from civitai_metadata_fixer import parse_a1111_params, split_a1111_params, format_a1111_params
+
+SAMPLES = [
+    'a photo of a cat\nNegative prompt: blurry\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x512',
+    'masterpiece, best quality, 1girl, (smile:1.2), <lora:detail:0.6>, city street at night, neon lights\n'
+    'Negative prompt: lowres, bad anatomy, bad hands, text, error, missing fingers, worst quality\n'
+    'Steps: 30, Sampler: DPM++ 2M Karras, CFG scale: 7.5, Seed: 3141592653, Size: 832x1216, '
+    'Model hash: 31e35c80fc, Model: sd_xl_base_1.0, Denoising strength: 0.4, Hires upscale: 1.5, '
+    'Hires upscaler: 4x-UltraSharp, Lora hashes: "detail: 62a595c4bfb5", ADetailer model: face_yolov8n.pt, '
+    'ADetailer prompt: "smiling face, detailed eyes", Version: v1.7.0',
+    'landscape, mountains\nNegative prompt: fog\n'
+    'Steps: 25, Sampler: UniPC, CFG scale: 5, Seed: 42, Size: 1024x1024, Model: juggernaut',
+]
+# Only checked for an exact round trip: no prompt, no negative prompt or no settings line
+ROUND_TRIP_SAMPLES = SAMPLES + [
+    'Negative prompt: x\nSteps: 20, Sampler: Euler a, CFG scale: 7',
+    'Steps: 20, Sampler: Euler a, CFG scale: 7',
+    'Steps: 20, Sampler: Euler a',
+    'landscape, mountains\nSteps: 25, Sampler: UniPC, CFG scale: 5, Seed: 42, Size: 1024x1024, Model: juggernaut',
+    'just a prompt',
+]
+
+def legacy_parse_a1111_params(params_str):
+    """The regex cascade parse_a1111_params used before the tokenizer"""
+    parsed = {}
+    parts = params_str.split("Negative prompt:")
+    if len(parts) >= 2:
+        parsed['prompt'] = parts[0].strip()
+        rest = parts[1]
+        settings_start = len(rest)
+        for marker in ["Steps:", "Sampler:", "CFG"]:
+            pos = rest.find(marker)
+            if pos != -1 and pos < settings_start:
+                settings_start = pos
+        parsed['negative'] = rest[:settings_start].strip()
+        settings = rest[settings_start:]
+    else:
+        parsed['prompt'] = params_str.strip()
+        settings = ""
+    if settings:
+        for key, pattern in (('steps', r'Steps:\s*(\d+)'), ('sampler', r'Sampler:\s*([^,]+)'),
+                             ('cfg', r'CFG scale:\s*([\d.]+)'), ('seed', r'Seed:\s*(\d+)'),
+                             ('model', r'Model:\s*([^,]+)'), ('model_hash', r'Model hash:\s*([a-fA-F0-9]+)')):
+            match = re.search(pattern, settings)
+            if match:
+                parsed[key] = match.group(1).strip()
+    return parsed
+
+def bench(func, sample, count):
+    """Return parses per second of func on sample"""
+    start = time.perf_counter()
+    for _ in range(count):
+        func(sample)
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000, help='parses per function and sample')
+    args = parser.parse_args()
+    
+    for sample in ROUND_TRIP_SAMPLES:
+        assert format_a1111_params(*split_a1111_params(sample)) == sample, sample
+    
+    print(f"{'sample':>6} {'legacy/s':>12} {'keys':>5} {'tokenizer/s':>12} {'keys':>5} {'speedup':>8}")
+    for i, sample in enumerate(SAMPLES, 1):
+        legacy = bench(legacy_parse_a1111_params, sample, args.count)
+        current = bench(parse_a1111_params, sample, args.count)
+        legacy_keys = len(legacy_parse_a1111_params(sample))
+        current_keys = len(split_a1111_params(sample)[2]) + 2
+        print(f"{i:>6} {legacy:>12,.0f} {legacy_keys:>5} {current:>12,.0f} {current_keys:>5} {current / legacy:>7.2f}x")
+
+if __name__ == '__main__':
+    main()
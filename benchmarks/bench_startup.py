@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Measure cold start-up time of the command line and web entry points.
+
+Runs each command in a fresh interpreter several times and reports the median
+wall time, and checks that the command line modes don't import Flask or
+Pillow. Exits non-zero if a check fails or a median is above --max-ms.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --max-ms 150
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT = os.path.join(ROOT, 'civitai_metadata_fixer.py')
+HEAVY_MODULES = ('flask', 'werkzeug', 'jinja2', 'PIL')
+
+def commands(workdir):
+    """Name -> argv of the entry points to time"""
+    db = os.path.join(workdir, 'catalog.sqlite')
+    return {
+        'import': [sys.executable, '-c', 'import civitai_metadata_fixer'],
+        'help': [sys.executable, SCRIPT, '--help'],
+        'search': [sys.executable, SCRIPT, 'search', '--db', db, 'nothing'],
+        'fix_empty_dir': [sys.executable, SCRIPT, 'fix', workdir, '-j', '1'],
+        'web_app_ready': [sys.executable, '-c', 'import civitai_metadata_fixer as f; f.app'],
+    }
+
+def time_command(argv, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e3
+
+def heavy_imports():
+    """Heavy modules loaded by a plain import of the tool"""
+    code = ('import sys, civitai_metadata_fixer; '
+            f'print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return out.stdout.split()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='runs per command')
+    parser.add_argument('--max-ms', type=float, help='fail if a command line median is slower than this')
+    args = parser.parse_args()
+
+    status = 0
+    loaded = heavy_imports()
+    if loaded:
+        print(f"FAIL importing the tool also loads {', '.join(loaded)}")
+        status = 1
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, argv in commands(workdir).items():
+            median = time_command(argv, args.runs)
+            print(f"{name:16} {median:8.1f} ms")
+            if args.max_ms and name != 'web_app_ready' and median > args.max_ms:
+                print(f"FAIL {name} is slower than {args.max_ms:.0f} ms")
+                status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
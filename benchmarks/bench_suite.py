@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Benchmark load, parse and save across image sizes, formats and metadata.
+
+Builds synthetic PNG/JPEG/WebP inputs, times every stage both through the
+Flask test client and by calling the functions directly, and writes latency
+percentiles, throughput and peak RSS growth to a JSON file. Pass --baseline
+to compare against an earlier run and fail on regressions.
+
+Usage:
+    python benchmarks/bench_suite.py --output bench.json
+    python benchmarks/bench_suite.py --sizes 512 1024 --baseline bench.json --threshold 0.2
+    python benchmarks/bench_suite.py --stages fix_file --sizes 1024 8192 --max-rss-fraction 0.02
+    python benchmarks/bench_suite.py --stages reencode_fn --formats jpeg --png-threads 1 4
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import civitai_metadata_fixer as fixer
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import PIL
+
+A1111_PARAMETERS = (
+    'masterpiece, best quality, 1girl, city street at night, neon lights, <lora:detail:0.6>\n'
+    'Negative prompt: lowres, bad anatomy, bad hands, text, error, worst quality\n'
+    'Steps: 30, Sampler: DPM++ 2M Karras, CFG scale: 7.5, Seed: 3141592653, Size: 832x1216, '
+    'Model hash: 31e35c80fc, Model: sd_xl_base_1.0, Denoising strength: 0.4, Hires upscale: 1.5, '
+    'Lora hashes: "detail: 62a595c4bfb5", Version: v1.7.0'
+)
+NEW_PARAMETERS = 'a benchmark image\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x512'
+# ComfyUI's default text-to-image graph in API format, as stored in the 'prompt' chunk
+COMFYUI_PROMPT = json.dumps({
+    '3': {'class_type': 'KSampler', 'inputs': {
+        'seed': 156680208700286, 'steps': 20, 'cfg': 8, 'sampler_name': 'euler', 'scheduler': 'normal',
+        'denoise': 1, 'model': ['4', 0], 'positive': ['6', 0], 'negative': ['7', 0], 'latent_image': ['5', 0]}},
+    '4': {'class_type': 'CheckpointLoaderSimple', 'inputs': {'ckpt_name': 'sd_xl_base_1.0.safetensors'}},
+    '5': {'class_type': 'EmptyLatentImage', 'inputs': {'width': 512, 'height': 512, 'batch_size': 1}},
+    '6': {'class_type': 'CLIPTextEncode', 'inputs': {
+        'text': 'beautiful scenery nature glass bottle landscape, purple galaxy bottle', 'clip': ['4', 1]}},
+    '7': {'class_type': 'CLIPTextEncode', 'inputs': {'text': 'text, watermark', 'clip': ['4', 1]}},
+    '8': {'class_type': 'VAEDecode', 'inputs': {'samples': ['3', 0], 'vae': ['4', 2]}},
+    '9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'ComfyUI', 'images': ['8', 0]}},
+})
+
+def comfyui_workflow(target_bytes):
+    """A ComfyUI-style workflow JSON of roughly target_bytes"""
+    rng = random.Random(0)
+    nodes = []
+    while sum(len(json.dumps(n)) for n in nodes[-1:]) * len(nodes) < target_bytes:
+        i = len(nodes)
+        nodes.append({
+            'id': i, 'type': rng.choice(['KSampler', 'CLIPTextEncode', 'VAEDecode', 'LoraLoader']),
+            'pos': [rng.random() * 4000, rng.random() * 4000], 'size': [315, 262],
+            'inputs': [{'name': 'model', 'type': 'MODEL', 'link': i}],
+            'widgets_values': ['prompt text ' * 20, rng.randrange(2 ** 32), 20, 7, 'euler', 'normal', 1],
+        })
+    return json.dumps({'last_node_id': len(nodes), 'nodes': nodes, 'links': [], 'version': 0.4})
+
+def make_image(size):
+    """Deterministic test picture: noise over a gradient, so it doesn't compress to nothing"""
+    noise = Image.effect_noise((size, size), 24)
+    gradient = Image.linear_gradient('L').resize((size, size))
+    return Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+
+def build_cases(sizes, formats, workflow_mb):
+    """Return {case name: (image bytes, parameters or None)}"""
+    workflow = comfyui_workflow(int(workflow_mb * 1024 * 1024)) if workflow_mb else None
+    cases = {}
+    for size in sizes:
+        img = make_image(size)
+        for fmt in formats:
+            if fmt == 'png':
+                variants = {'none': None, 'a1111': A1111_PARAMETERS}
+                if workflow:
+                    variants['comfyui'] = None
+                for label, params in variants.items():
+                    info = PngInfo()
+                    if params:
+                        info.add_text('parameters', params)
+                    if label == 'comfyui':
+                        info.add_text('workflow', workflow)
+                        info.add_text('prompt', COMFYUI_PROMPT)
+                    out = io.BytesIO()
+                    img.save(out, 'PNG', pnginfo=info, compress_level=6)
+                    cases[f'png-{size}-{label}'] = (out.getvalue(), params)
+            else:
+                out = io.BytesIO()
+                img.save(out, 'JPEG' if fmt == 'jpeg' else 'WEBP', quality=90)
+                cases[f'{fmt}-{size}-none'] = (out.getvalue(), None)
+    return cases
+
+def stage_functions(client, src, dst):
+    """Stage name -> function(image bytes, parameters) to time; fix_file works on the src file"""
+    return {
+        'load_http': lambda data, params: client.post(
+            '/load-image', data=data, content_type='application/octet-stream').get_data(),
+        'load_fn': lambda data, params: fixer.read_image_metadata(io.BytesIO(data)),
+        'parse': lambda data, params: fixer.parse_a1111_params(params),
+        'save_http': lambda data, params: client.post(
+            '/save-image', query_string={'parameters': NEW_PARAMETERS}, data=data,
+            content_type='application/octet-stream').get_data(),
+        'save_fn': lambda data, params: fixer.write_parameters(data, NEW_PARAMETERS),
+        'fix_file': lambda data, params: fixer.fix_file(src, dst, NEW_PARAMETERS),
+        'reencode_fn': lambda data, params: fixer.reencode_png(data, NEW_PARAMETERS),
+    }
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(stage, case, repeat, png_threads=None):
+    """Time one stage on one case; runs in a fresh child so peak RSS is per stage"""
+    data, params = CASES[case]
+    if png_threads:
+        fixer.png_threads = png_threads
+    workdir = tempfile.mkdtemp()
+    src, dst = os.path.join(workdir, 'src'), os.path.join(workdir, 'dst')
+    with open(src, 'wb') as f:
+        f.write(data)
+    func = stage_functions(fixer.app.test_client(), src, dst)[stage]
+    if stage == 'parse':
+        repeat *= 1000
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func(data, params)  # warm-up
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data, params)
+        timings.append(time.perf_counter() - start)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    shutil.rmtree(workdir)
+
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'p50_ms': percentile(timings, 0.5) * 1e3,
+        'p90_ms': percentile(timings, 0.9) * 1e3,
+        'p99_ms': percentile(timings, 0.99) * 1e3,
+        'mean_ms': mean * 1e3,
+        'ops_per_s': 1 / mean,
+        'mb_per_s': len(data) / mean / 1e6 if stage != 'parse' else None,
+        'input_bytes': len(data),
+        'peak_rss_growth_mb': (rss_after - rss_before) * rss_unit / 1e6,
+    }
+
+CASES = {}
+RSS_SLACK_MB = 8  # allowed peak RSS difference between two inputs of about the same size
+
+def peak_rss_mb():
+    """Peak RSS of this process image in MB.
+    
+    Linux carries ru_maxrss over fork and exec, so a new child would report
+    the bench's own peak; VmHWM starts afresh with every exec.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024 / 1e6
+    except OSError:
+        pass
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 1e6
+
+def fix_file_peak_rss(paths):
+    """Peak RSS in MB after fix_file on each path in turn, in a freshly spawned process"""
+    peaks = []
+    for path in paths:
+        fixer.fix_file(path, path + '.out', NEW_PARAMETERS)
+        os.remove(path + '.out')
+        peaks.append(peak_rss_mb())
+    return peaks
+
+def check_memory_scaling(max_fraction):
+    """Return lines for formats whose fix_file peak RSS grows with the input size.
+    
+    The smallest and then the largest input of each format run in one spawned
+    child, which holds none of the other inputs, and the difference of the two
+    peaks may be at most RSS_SLACK_MB plus max_fraction of the extra input bytes.
+    """
+    groups = {}
+    for case in CASES:
+        fmt, size, label = case.split('-')
+        groups.setdefault((fmt, label), []).append((int(size), case))
+    ctx = multiprocessing.get_context('spawn')
+    workdir = tempfile.mkdtemp()
+    failures = []
+    for sized in groups.values():
+        if len(sized) < 2:
+            continue
+        sized.sort()
+        small, large = sized[0][1], sized[-1][1]
+        paths = []
+        for case in (small, large):
+            paths.append(os.path.join(workdir, case))
+            with open(paths[-1], 'wb') as f:
+                f.write(CASES[case][0])
+        with ctx.Pool(1) as pool:
+            peak_small, peak_large = pool.apply(fix_file_peak_rss, (paths,))
+        extra_input = (len(CASES[large][0]) - len(CASES[small][0])) / 1e6
+        growth = peak_large - peak_small
+        print(f"fix_file memory {small} -> {large}: +{extra_input:.1f} MB input, +{growth:.1f} MB peak RSS")
+        if growth > RSS_SLACK_MB + max_fraction * extra_input:
+            failures.append(f"{small} -> {large}: peak RSS grew {growth:.1f} MB for {extra_input:.1f} MB more input")
+    shutil.rmtree(workdir)
+    return failures
+
+def compare(results, baseline, threshold):
+    """Return lines describing p50 regressions beyond threshold"""
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old and result['p50_ms'] > old['p50_ms'] * (1 + threshold):
+            regressions.append(f"{key}: p50 {old['p50_ms']:.2f} ms -> {result['p50_ms']:.2f} ms "
+                               f"(+{result['p50_ms'] / old['p50_ms'] - 1:.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096, 8192])
+    parser.add_argument('--formats', nargs='+', default=['png', 'jpeg', 'webp'], choices=['png', 'jpeg', 'webp'])
+    parser.add_argument('--stages', nargs='+',
+                        default=['load_http', 'load_fn', 'parse', 'save_http', 'save_fn', 'fix_file'])
+    parser.add_argument('--workflow-mb', type=float, default=2, help='size of the ComfyUI workflow chunk (0 to skip)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per stage and case')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='allowed p50 slowdown, as a fraction')
+    parser.add_argument('--png-threads', type=int, nargs='+', default=[None],
+                        help='compression thread counts to run reencode_fn with (default: the tool\'s own)')
+    parser.add_argument('--max-rss-fraction', type=float, default=0.05,
+                        help='fail if fix_file needs more than this fraction of the extra input bytes '
+                             'as extra peak RSS on the largest size than on the smallest')
+    args = parser.parse_args()
+
+    print("Building inputs...", flush=True)
+    CASES.update(build_cases(args.sizes, args.formats, args.workflow_mb))
+
+    # fork, so children share the inputs instead of rebuilding them
+    ctx = multiprocessing.get_context('fork')
+    results = {}
+    for case, (data, params) in CASES.items():
+        for stage in args.stages:
+            if stage == 'parse' and not params:
+                continue
+            for threads in args.png_threads if stage == 'reencode_fn' else [None]:
+                with ctx.Pool(1) as pool:
+                    result = pool.apply(measure, (stage, case, args.repeat, threads))
+                key = f'{stage}/{case}' + (f'/t{threads}' if threads else '')
+                results[key] = result
+                print(f"{key:32} p50 {result['p50_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  "
+                      f"{result['ops_per_s']:10.1f} ops/s  +{result['peak_rss_growth_mb']:7.1f} MB RSS", flush=True)
+
+    report = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    status = 0
+    if 'fix_file' in args.stages:
+        # fix_file streams, so its memory use must not follow the image size
+        for line in check_memory_scaling(args.max_rss_fraction):
+            print(f"MEMORY {line}")
+            status = 1
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,18 +4,100 @@ Civitai Metadata Fixer Tool - Web Version
 Adds or fixes PNG metadata to make images compatible with Civitai uploads.
 """
 
-from flask import Flask, render_template_string, request, jsonify, send_file
-from PIL import Image
-from PIL.PngImagePlugin import PngInfo
 import os
 import io
+import sys
+import time
 import base64
+import random
+import hashlib
+import threading
+import signal
+import socket
+import select
+import bisect
+import traceback
+import collections
 import re
+import json
+import csv
+import fnmatch
+import struct
+import tempfile
+import zipfile
+import itertools
+import sqlite3
+import zlib
+import gzip
+import argparse
+import contextlib
+import multiprocessing
+from collections import OrderedDict
 from pathlib import Path
-import webbrowser
 from threading import Timer
 
-app = Flask(__name__)
+# Flask, Pillow and the rest of the heavy imports are loaded on first use:
+# the command line modes mostly need neither, and start-up time matters when
+# the tool is launched once per job.
+
+class DeferredSetup:
+    """Records route and hook decorators until create_app() builds the Flask app.
+    
+    Works like a Flask blueprint that needs no Flask, so importing the module
+    doesn't load it; the handlers import the Flask names they use themselves.
+    """
+    
+    def __init__(self):
+        self.setup = []
+    
+    def route(self, rule, **options):
+        def decorator(func):
+            self.setup.append(lambda flask_app: flask_app.route(rule, **options)(func))
+            return func
+        return decorator
+    
+    def errorhandler(self, code_or_exception):
+        def decorator(func):
+            self.setup.append(lambda flask_app: flask_app.errorhandler(code_or_exception)(func))
+            return func
+        return decorator
+    
+    def before_request(self, func):
+        self.setup.append(lambda flask_app: flask_app.before_request(func))
+        return func
+    
+    def after_request(self, func):
+        self.setup.append(lambda flask_app: flask_app.after_request(func))
+        return func
+    
+    def teardown_request(self, func):
+        self.setup.append(lambda flask_app: flask_app.teardown_request(func))
+        return func
+
+web = DeferredSetup()
+app_lock = threading.Lock()
+
+def create_app():
+    """A new Flask app with every route and hook of the tool"""
+    from flask import Flask
+    flask_app = Flask(__name__)
+    for register in web.setup:
+        register(flask_app)
+    return flask_app
+
+def get_app():
+    """The module's Flask app, created on the first call"""
+    with app_lock:
+        if 'app' not in globals():
+            globals()['app'] = create_app()
+    return globals()['app']
+
+def __getattr__(name):
+    # `app` is a real Flask app, made when first asked for, so WSGI hosts and
+    # `flask --app civitai_metadata_fixer run` work while a plain import stays light
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -150,12 +232,34 @@ HTML_TEMPLATE = '''
         .checkbox-group { display: flex; align-items: center; gap: 8px; }
         .checkbox-group input { width: auto; }
         .info-text { font-size: 12px; color: #666; margin-top: 4px; }
+        #library-card { display: none; }
+        #library-list { max-height: 260px; overflow-y: auto; margin-bottom: 12px; }
+        .library-item {
+            padding: 6px 10px;
+            border-radius: 6px;
+            cursor: pointer;
+            color: #a0a0a0;
+        }
+        .library-item:hover { background: rgba(233,69,96,0.15); color: #fff; }
     </style>
 </head>
 <body>
     <div class="container">
         <h1>🖼️ Civitai Metadata Fixer</h1>
         
+        <div class="card" id="library-card">
+            <h2>📚 Library</h2>
+            <p id="library-dir" class="info-text"></p>
+            <div id="library-list"></div>
+            <div class="form-group">
+                <label for="save-mode">Save library images</label>
+                <select id="save-mode">
+                    <option value="sibling">As a *_civitai copy next to the original</option>
+                    <option value="inplace">In place, replacing the original</option>
+                </select>
+            </div>
+        </div>
+
         <div class="card">
             <h2>📁 Select Image</h2>
             <div class="drop-zone" id="drop-zone">
@@ -243,7 +347,7 @@ HTML_TEMPLATE = '''
                 </div>
 
                 <div class="button-group">
-                    <button type="button" class="btn btn-primary" onclick="saveImage(false)">
+                    <button type="button" class="btn btn-primary" id="save-button" onclick="saveImage(false)">
                         💾 Download Fixed Image
                     </button>
                     <button type="button" class="btn btn-secondary" onclick="previewMetadata()">
@@ -259,8 +363,11 @@ HTML_TEMPLATE = '''
     </div>
 
     <script>
-        let currentImageData = null;
+        let currentFile = null;
+        let currentHandle = null;
         let currentFilename = 'image.png';
+        let currentPath = null;
+        let libraryDir = '';
         
         const dropZone = document.getElementById('drop-zone');
         const fileInput = document.getElementById('file-input');
@@ -280,43 +387,104 @@ HTML_TEMPLATE = '''
             if (e.target.files.length) handleFile(e.target.files[0]);
         });
         
+        function showPreview(src) {
+            const preview = document.getElementById('preview-image');
+            if (preview.src.startsWith('blob:')) URL.revokeObjectURL(preview.src);
+            preview.src = src;
+            document.getElementById('preview-container').style.display = 'block';
+        }
+        
         function handleFile(file) {
+            currentFile = file;
+            currentHandle = null;
+            currentPath = null;
             currentFilename = file.name;
-            const reader = new FileReader();
-            reader.onload = (e) => {
-                currentImageData = e.target.result;
-                document.getElementById('preview-image').src = currentImageData;
-                document.getElementById('preview-container').style.display = 'block';
-                
-                // Send to server to extract metadata
-                fetch('/load-image', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({image: currentImageData, filename: currentFilename})
-                })
-                .then(res => res.json())
-                .then(data => {
-                    document.getElementById('image-info').textContent = 
-                        `${data.width}x${data.height} • ${file.name}`;
-                    document.getElementById('width').value = data.width;
-                    document.getElementById('height').value = data.height;
-                    document.getElementById('current-metadata').textContent = 
-                        data.metadata || 'No metadata found';
-                    
-                    // Fill form if metadata was parsed
-                    if (data.parsed) {
-                        if (data.parsed.prompt) document.getElementById('prompt').value = data.parsed.prompt;
-                        if (data.parsed.negative) document.getElementById('negative').value = data.parsed.negative;
-                        if (data.parsed.steps) document.getElementById('steps').value = data.parsed.steps;
-                        if (data.parsed.sampler) document.getElementById('sampler').value = data.parsed.sampler;
-                        if (data.parsed.cfg) document.getElementById('cfg').value = data.parsed.cfg;
-                        if (data.parsed.seed) document.getElementById('seed').value = data.parsed.seed;
-                        if (data.parsed.model) document.getElementById('model').value = data.parsed.model;
-                        if (data.parsed.model_hash) document.getElementById('model_hash').value = data.parsed.model_hash;
-                    }
-                });
-            };
-            reader.readAsDataURL(file);
+            document.getElementById('save-button').textContent = '💾 Download Fixed Image';
+            showPreview(URL.createObjectURL(file));
+            
+            // Send raw bytes to server to extract metadata
+            fetch('/load-image', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/octet-stream'},
+                body: file
+            })
+            .then(res => res.json())
+            .then(data => {
+                currentHandle = data.handle;
+                showLoadResult(data, file.name);
+            });
+        }
+        
+        function openLibraryDir(dir) {
+            // The server only answers when it was started with --library
+            return fetch('/library?dir=' + encodeURIComponent(dir))
+            .then(res => {
+                if (!res.ok) throw new Error('no library');
+                return res.json();
+            })
+            .then(data => {
+                libraryDir = data.dir;
+                document.getElementById('library-dir').textContent = '/' + data.dir;
+                const list = document.getElementById('library-list');
+                list.replaceChildren();
+                const addItem = (label, onclick) => {
+                    const item = document.createElement('div');
+                    item.className = 'library-item';
+                    item.textContent = label;
+                    item.addEventListener('click', onclick);
+                    list.appendChild(item);
+                };
+                const join = name => data.dir ? data.dir + '/' + name : name;
+                if (data.parent !== null) addItem('⬆️ ..', () => openLibraryDir(data.parent));
+                data.dirs.forEach(name => addItem('📁 ' + name, () => openLibraryDir(join(name))));
+                data.files.forEach(file => addItem('🖼️ ' + file.name, () => loadLibraryImage(join(file.name), file.name)));
+            });
+        }
+        
+        function loadLibraryImage(path, name) {
+            // The server reads the file itself, so nothing is uploaded
+            currentFile = null;
+            currentHandle = null;
+            currentPath = path;
+            currentFilename = name;
+            document.getElementById('save-button').textContent = '💾 Save Fixed Image';
+            showPreview('/library/file?path=' + encodeURIComponent(path));
+            fetch('/load-image', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({path: path})
+            })
+            .then(res => res.json())
+            .then(data => showLoadResult(data, name));
+        }
+        
+        openLibraryDir('')
+        .then(() => document.getElementById('library-card').style.display = 'block')
+        .catch(() => {});
+        
+        function showLoadResult(data, name) {
+            if (data.error) {
+                showStatus(data.error, 'error');
+                return;
+            }
+            document.getElementById('image-info').textContent = 
+                `${data.width}x${data.height} • ${name}`;
+            document.getElementById('width').value = data.width;
+            document.getElementById('height').value = data.height;
+            document.getElementById('current-metadata').textContent = 
+                data.metadata || 'No metadata found';
+            
+            // Fill form if metadata was parsed
+            if (data.parsed) {
+                if (data.parsed.prompt) document.getElementById('prompt').value = data.parsed.prompt;
+                if (data.parsed.negative) document.getElementById('negative').value = data.parsed.negative;
+                if (data.parsed.steps) document.getElementById('steps').value = data.parsed.steps;
+                if (data.parsed.sampler) document.getElementById('sampler').value = data.parsed.sampler;
+                if (data.parsed.cfg) document.getElementById('cfg').value = data.parsed.cfg;
+                if (data.parsed.seed) document.getElementById('seed').value = data.parsed.seed;
+                if (data.parsed.model) document.getElementById('model').value = data.parsed.model;
+                if (data.parsed.model_hash) document.getElementById('model_hash').value = data.parsed.model_hash;
+            }
         }
         
         function buildMetadata() {
@@ -366,14 +534,32 @@ HTML_TEMPLATE = '''
             if (!document.getElementById('model').value.trim()) {
                 document.getElementById('model').value = 'sd_xl_base_1.0';
             }
-            if (!document.getElementById('model_hash').value.trim()) {
-                document.getElementById('model_hash').value = 'be9edd61';
-            }
-            showStatus('Auto-filled with valid metadata! Click "Download Fixed Image" to save.', 'success');
+            const autoHash = document.getElementById('model_hash').value.trim() ? Promise.resolve() : lookupModelHash();
+            autoHash.then(() => {
+                // The placeholder hash is only right for the placeholder model
+                if (!document.getElementById('model_hash').value.trim() &&
+                    document.getElementById('model').value.trim() === 'sd_xl_base_1.0') {
+                    document.getElementById('model_hash').value = 'be9edd61';
+                }
+                showStatus('Auto-filled with valid metadata! Click "Download Fixed Image" to save.', 'success');
+            });
         }
         
+        function lookupModelHash() {
+            // Fill the hash from the server's index of local model files
+            const model = document.getElementById('model').value.trim();
+            if (!model) return Promise.resolve();
+            return fetch('/model-hash?name=' + encodeURIComponent(model))
+                .then(res => res.ok ? res.json() : null)
+                .then(data => {
+                    if (data) document.getElementById('model_hash').value = data.hash;
+                })
+                .catch(() => {});
+        }
+        document.getElementById('model').addEventListener('change', lookupModelHash);
+        
         function saveImage(overwrite) {
-            if (!currentImageData) {
+            if (!currentFile && !currentPath) {
                 showStatus('Please load an image first', 'error');
                 return;
             }
@@ -384,21 +570,29 @@ HTML_TEMPLATE = '''
             
             const metadata = buildMetadata();
             
-            fetch('/save-image', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    image: currentImageData,
-                    filename: currentFilename,
-                    parameters: metadata
-                })
-            })
+            if (currentPath) {
+                saveLibraryImage(metadata);
+                return;
+            }
+            
+            // Reuse the upload cached by /load-image; send the file only if it expired
+            const send = (withFile) => {
+                const form = new FormData();
+                if (withFile) form.append('image', currentFile, currentFilename);
+                else form.append('handle', currentHandle);
+                form.append('parameters', metadata);
+                return fetch('/save-image', {method: 'POST', body: form});
+            };
+            
+            send(!currentHandle)
+            .then(res => res.status === 409 ? send(true) : res)
             .then(res => res.blob())
             .then(blob => {
                 const url = URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.href = url;
-                a.download = currentFilename.replace(/\\.[^.]+$/, '_civitai.png');
+                const ext = {'image/jpeg': '.jpg', 'image/webp': '.webp'}[blob.type] || '.png';
+                a.download = currentFilename.replace(/\\.[^.]+$/, '_civitai' + ext);
                 document.body.appendChild(a);
                 a.click();
                 document.body.removeChild(a);
@@ -408,6 +602,24 @@ HTML_TEMPLATE = '''
             .catch(err => showStatus('Error: ' + err.message, 'error'));
         }
         
+        function saveLibraryImage(metadata) {
+            fetch('/save-image', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    path: currentPath,
+                    parameters: metadata,
+                    mode: document.getElementById('save-mode').value
+                })
+            })
+            .then(res => res.json().then(data => {
+                if (!res.ok) throw new Error(data.error);
+                showStatus('Saved ' + data.path + ' with Civitai-compatible metadata!', 'success');
+                return openLibraryDir(libraryDir);
+            }))
+            .catch(err => showStatus('Error: ' + err.message, 'error'));
+        }
+        
         function showStatus(message, type) {
             const status = document.getElementById('status');
             status.textContent = message;
@@ -418,131 +630,3176 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-@app.route('/')
+# Rendered and compressed once, on the first request: (etag, {encoding: body})
+ui_page = None
+
+def render_ui_page():
+    global ui_page
+    from flask import render_template_string
+    if ui_page is None:
+        html = render_template_string(HTML_TEMPLATE).encode('utf-8')
+        bodies = {'identity': html, 'gzip': gzip.compress(html, 9, mtime=0)}
+        try:
+            import brotli
+            bodies['br'] = brotli.compress(html)
+        except ImportError:
+            pass
+        ui_page = (hashlib.sha256(html).hexdigest()[:16], bodies)
+    return ui_page
+
+@web.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    from flask import Response, request
+    etag, bodies = render_ui_page()
+    encoding = next((name for name in ('br', 'gzip') if name in bodies and request.accept_encodings[name]),
+                    'identity')
+    response = Response(bodies[encoding], mimetype='text/html')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{etag}-{encoding}")
+    return response.make_conditional(request)
 
-@app.route('/load-image', methods=['POST'])
-def load_image():
-    data = request.json
-    image_data = data['image']
+METRIC_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+
+class Metric:
+    """Minimal Prometheus counter/histogram with labels"""
+    
+    def __init__(self, name, help_text, buckets=None):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+    
+    def render(self):
+        kind = 'histogram' if self.buckets else 'counter'
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {kind}"]
+        with self._lock:
+            items = sorted(self.values.items())
+            items = [(key, list(value) if self.buckets else value) for key, value in items]
+        for key, value in items:
+            if not self.buckets:
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {value[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+def format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+STAGE_SECONDS = Metric('civitai_fixer_stage_seconds', 'Time spent in each load/save stage', METRIC_LATENCY_BUCKETS)
+REQUEST_SECONDS = Metric('civitai_fixer_request_seconds', 'Request latency by endpoint', METRIC_LATENCY_BUCKETS)
+REQUEST_BYTES = Metric('civitai_fixer_request_bytes', 'Request body size by endpoint', METRIC_BYTES_BUCKETS)
+RESPONSE_BYTES = Metric('civitai_fixer_response_bytes', 'Response body size by endpoint', METRIC_BYTES_BUCKETS)
+PARSE_FAILURES = Metric('civitai_fixer_parse_failures_total', 'Parameters without a readable settings line')
+FALLBACKS = Metric('civitai_fixer_fallbacks_total', 'Times a fast path fell back to Pillow')
+METRICS = (STAGE_SECONDS, REQUEST_SECONDS, REQUEST_BYTES, RESPONSE_BYTES, PARSE_FAILURES, FALLBACKS)
+
+# Off unless asked for: when disabled, timed() hands out a shared no-op context
+metrics_enabled = os.environ.get('CIVITAI_FIXER_METRICS', '0') == '1'
+profiling_enabled = os.environ.get('CIVITAI_FIXER_PROFILING', '0') == '1'
+NO_TIMER = contextlib.nullcontext()
+
+class StageTimer:
+    __slots__ = ('stage', 'start')
+    
+    def __init__(self, stage):
+        self.stage = stage
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+    
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, stage=self.stage)
+
+def timed(stage):
+    """Context manager recording how long a load/save stage takes"""
+    return StageTimer(stage) if metrics_enabled else NO_TIMER
+
+def count(metric, **labels):
+    if metrics_enabled:
+        metric.inc(**labels)
+
+class SamplingProfiler:
+    """Samples one thread's stack every interval seconds from a helper thread.
+    
+    Stacks are written in the collapsed "a;b;c count" format that flamegraph
+    tools read. Only used for requests that ask for it.
+    """
+    
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = traceback.extract_stack(frame)
+                self.stacks[';'.join(f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})" for f in stack)] += 1
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+@web.before_request
+def start_request_metrics():
+    from flask import request
+    if metrics_enabled:
+        request.environ['civitai_fixer.start'] = time.perf_counter()
+    if profiling_enabled and (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'):
+        profiler = SamplingProfiler(threading.get_ident())
+        profiler.start()
+        request.environ['civitai_fixer.profiler'] = profiler
+
+@web.after_request
+def record_request_metrics(response):
+    from flask import request
+    profiler = request.environ.pop('civitai_fixer.profiler', None)
+    if profiler is not None:
+        directory = os.environ.get('CIVITAI_FIXER_PROFILE_DIR', tempfile.gettempdir())
+        path = os.path.join(directory, f"civitai_fixer_profile_{time.time_ns()}.txt")
+        if response.is_streamed:
+            response.response = profile_streamed_body(response.response, profiler, path)
+        else:
+            profiler.stop(path)
+        response.headers['X-Profile-File'] = path
+    start = request.environ.get('civitai_fixer.start')
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_BYTES.observe(request.content_length or 0, endpoint=endpoint)
+    if response.is_streamed:
+        # Most of a streamed response's work happens after this hook returns
+        response.response = count_streamed_body(response.response, endpoint, start)
+    else:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        RESPONSE_BYTES.observe(response.content_length or 0, endpoint=endpoint)
+    return response
+
+def profile_streamed_body(body, profiler, path):
+    try:
+        yield from body
+    finally:
+        profiler.stop(path)
+
+def count_streamed_body(body, endpoint, start):
+    total = 0
+    for block in body:
+        total += len(block)
+        yield block
+    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+    RESPONSE_BYTES.observe(total, endpoint=endpoint)
+
+@web.route('/metrics')
+def metrics():
+    from flask import Response
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    stats = upload_cache.stats()
+    for name in ('hits', 'misses', 'evictions'):
+        lines.append(f"# TYPE civitai_fixer_upload_cache_{name}_total counter")
+        lines.append(f"civitai_fixer_upload_cache_{name}_total {stats[name]}")
+    lines.append("# TYPE civitai_fixer_upload_cache_bytes gauge")
+    lines.append(f"civitai_fixer_upload_cache_bytes {stats['bytes']}")
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+class UploadCache:
+    """Byte-bounded LRU cache of uploaded images, keyed by SHA-256.
+    
+    /load-image stores the upload and returns its hash as a handle, so
+    /save-image can reuse the bytes instead of receiving them a second time.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def put(self, data):
+        """Store data and return its handle, or None if it doesn't fit"""
+        if len(data) > self.max_bytes:
+            return None
+        handle = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if handle in self._items:
+                self._items.move_to_end(handle)
+                return handle
+            self._items[handle] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return handle
+    
+    def get(self, handle):
+        """Return the cached bytes for handle, or None on a miss"""
+        with self._lock:
+            data = self._items.get(handle)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(handle)
+            self.hits += 1
+            return data
+    
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+upload_cache = UploadCache(int(os.environ.get('CIVITAI_FIXER_CACHE_MB', '256')) * 1024 * 1024)
+
+CACHE_MISS_ERROR = 'Unknown or expired image handle, upload the image again'
+UNREADABLE_IMAGE_ERROR = 'Could not read the image, it is damaged or not an image file'
+DATA_URL_ERROR = 'Expected the image as a base64 data URL'
+
+@web.route('/cache-stats')
+def cache_stats():
+    from flask import jsonify
+    return jsonify(upload_cache.stats())
+
+def request_image_stream():
+    """Return (file object, fields) for a raw or multipart image upload.
     
-    # Decode base64 image
-    header, encoded = image_data.split(',', 1)
-    image_bytes = base64.b64decode(encoded)
-    img = Image.open(io.BytesIO(image_bytes))
+    Multipart bodies carry the image in an 'image' file field and metadata in
+    form fields; raw application/octet-stream bodies take metadata from the
+    query string. Either way the upload is read as a stream, never base64.
+    """
+    from flask import request
+    if request.mimetype == 'multipart/form-data':
+        return take_upload(request.files['image']), request.form
+    return io.BufferedReader(request.stream), request.args
+
+def take_upload(upload):
+    """Detach the spooled file of an upload so it outlives the request.
+    
+    The request closes its uploads on teardown, which happens before a
+    streamed response has been sent; the caller closes the file instead.
+    """
+    fp, upload.stream = upload.stream, io.BytesIO()
+    return fp
+
+def read_upload_metadata(fp):
+    """read_image_metadata() for a client's image; None if it can't be read"""
+    try:
+        with timed('read_metadata'):
+            return read_image_metadata(fp)
+    except Exception:
+        # Pillow raises all sorts of errors on garbage, and its messages name
+        # the file object, so the client only gets UNREADABLE_IMAGE_ERROR
+        return None
+
+def decode_data_url(image_data):
+    """Bytes of a base64 data URL, or None if it isn't one"""
+    try:
+        header, encoded = image_data.split(',', 1)
+        with timed('base64_decode'):
+            return base64.b64decode(encoded)
+    except (AttributeError, ValueError):
+        return None
+
+@web.route('/load-image', methods=['POST'])
+def load_image():
+    from flask import jsonify, request
+    if request.is_json and 'path' in request.json:
+        return load_library_image(request.json['path'])
+    if not request.is_json:
+        fp, fields = request_image_stream()
+        with fp:
+            if (request.content_length or 0) > upload_cache.max_bytes:
+                # Too big to cache anyway, so only read the header
+                meta = read_upload_metadata(fp)
+                if meta is None:
+                    return jsonify({'error': UNREADABLE_IMAGE_ERROR}), 400
+                return jsonify(build_load_result(meta))
+            image_bytes = fp.read()
+    else:
+        image_bytes = decode_data_url(request.json.get('image'))
+        if image_bytes is None:
+            return jsonify({'error': DATA_URL_ERROR}), 400
     
+    meta = read_upload_metadata(io.BytesIO(image_bytes))
+    if meta is None:
+        return jsonify({'error': UNREADABLE_IMAGE_ERROR}), 400
+    result = build_load_result(meta)
+    result['handle'] = upload_cache.put(image_bytes)
+    return jsonify(result)
+
+def build_load_result(meta):
+    """Turn {'width', 'height', 'text'} into the /load-image response"""
     result = {
-        'width': img.width,
-        'height': img.height,
+        'width': meta['width'],
+        'height': meta['height'],
         'metadata': '',
         'parsed': {}
     }
     
     # Extract metadata
-    if hasattr(img, 'info') and img.info:
+    text = meta['text']
+    if text:
         metadata_parts = []
-        for key, value in img.info.items():
-            if isinstance(value, str):
-                display = value[:1000] + '...' if len(value) > 1000 else value
-                metadata_parts.append(f"{key}: {display}")
+        for key, value in text.items():
+            display = value[:1000] + '...' if len(value) > 1000 else value
+            metadata_parts.append(f"{key}: {display}")
         result['metadata'] = '\n\n'.join(metadata_parts)
         
-        # Try to parse A1111 format
-        if 'parameters' in img.info:
-            result['parsed'] = parse_a1111_params(img.info['parameters'])
+        # Try to parse A1111 format, converting a ComfyUI graph if needed
+        params = image_parameters(text)
+        if params:
+            with timed('parse'):
+                result['parsed'] = parse_a1111_params(params)
+            if not result['parsed'].get('settings'):
+                count(PARSE_FAILURES)
     
-    return jsonify(result)
+    return result
+
+# One "Key: value" pair of an A1111 settings line; values containing commas,
+# colons or newlines are JSON-quoted. Same grammar as A1111's re_param.
+SETTING_RE = re.compile(r'(\w[\w \-/]*):\s*("(?:\\.|[^\\"])*"|[^,]*),?\s*')
+NEGATIVE_MARKER = 'Negative prompt:'
+
+# Settings keys that parse_a1111_params() also returns under their old names
+LEGACY_KEYS = {
+    'Steps': 'steps',
+    'Sampler': 'sampler',
+    'CFG scale': 'cfg',
+    'Seed': 'seed',
+    'Model': 'model',
+    'Model hash': 'model_hash',
+    'Clip skip': 'clip_skip',
+}
+
+def unquote_setting(value):
+    """Undo A1111's JSON quoting of a settings value"""
+    if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        return value
+    if '\\' not in value:
+        return value[1:-1]
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def quote_setting(value):
+    """Quote a settings value the way A1111 does"""
+    value = str(value)
+    if ',' not in value and '\n' not in value and ':' not in value:
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+def tokenize_settings(line):
+    """Tokenize an A1111 settings line into an ordered dict of every pair"""
+    return {key: unquote_setting(value) if value[:1] == '"' else value
+            for key, value in SETTING_RE.findall(line)}
+
+def split_a1111_params(params_str):
+    """Split a parameters string into (prompt, negative, settings dict).
+    
+    The settings line is tokenized with a single SETTING_RE scan, keeping
+    every key in order and unquoting quoted values. A last line with
+    fewer than three pairs is treated as prompt text, like A1111 does.
+    """
+    text = params_str.strip()
+    head, sep, last_line = text.rpartition('\n')
+    settings = tokenize_settings(last_line)
+    if len(settings) < 3:
+        settings = {}
+        head = text
+    
+    if head.startswith(NEGATIVE_MARKER):
+        prompt, negative = '', head[len(NEGATIVE_MARKER):]
+    else:
+        prompt, sep, negative = head.partition('\n' + NEGATIVE_MARKER)
+    return prompt.strip(), negative.strip(), settings
+
+def format_a1111_params(prompt, negative, settings):
+    """Inverse of split_a1111_params(): build a parameters string"""
+    lines = [prompt]
+    if negative:
+        lines.append(f"{NEGATIVE_MARKER} {negative}")
+    if settings:
+        lines.append(', '.join(f"{key}: {quote_setting(value)}" for key, value in settings.items()))
+    return '\n'.join(line for line in lines if line)
 
 def parse_a1111_params(params_str):
-    """Parse A1111 format parameters"""
-    parsed = {}
+    """Parse A1111 format parameters.
+    
+    Returns the prompt, negative prompt and the common settings under their
+    short names, plus every settings pair under 'settings'.
+    """
+    prompt, negative, settings = split_a1111_params(params_str)
+    parsed = {'prompt': prompt}
+    if negative:
+        parsed['negative'] = negative
+    for key, name in LEGACY_KEYS.items():
+        if key in settings:
+            parsed[name] = settings[key]
+    if settings:
+        parsed['settings'] = settings
+    return parsed
+
+# ComfyUI sampler/scheduler names -> A1111 sampler names
+COMFYUI_SAMPLERS = {
+    'euler': 'Euler',
+    'euler_ancestral': 'Euler a',
+    'heun': 'Heun',
+    'dpm_2': 'DPM2',
+    'dpm_2_ancestral': 'DPM2 a',
+    'lms': 'LMS',
+    'dpm_fast': 'DPM fast',
+    'dpm_adaptive': 'DPM adaptive',
+    'dpmpp_2s_ancestral': 'DPM++ 2S a',
+    'dpmpp_sde': 'DPM++ SDE',
+    'dpmpp_sde_gpu': 'DPM++ SDE',
+    'dpmpp_2m': 'DPM++ 2M',
+    'dpmpp_2m_sde': 'DPM++ 2M SDE',
+    'dpmpp_2m_sde_gpu': 'DPM++ 2M SDE',
+    'dpmpp_3m_sde': 'DPM++ 3M SDE',
+    'dpmpp_3m_sde_gpu': 'DPM++ 3M SDE',
+    'ddim': 'DDIM',
+    'uni_pc': 'UniPC',
+    'lcm': 'LCM',
+}
+COMFYUI_SCHEDULERS = {'karras': 'Karras', 'exponential': 'Exponential'}
+COMFYUI_TEXT_INPUTS = ('text', 'text_g', 'string', 'value', 'prompt')
+COMFYUI_MAX_DEPTH = 50
+
+def is_link(value):
+    """ComfyUI API-format inputs link to other nodes as [node id, output index]"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+def comfyui_chain(nodes, value, follow):
+    """Yield the nodes along a link, continuing through the first linked input named in follow"""
+    for _ in range(COMFYUI_MAX_DEPTH):
+        if not is_link(value):
+            return
+        node = nodes.get(str(value[0]))
+        if not isinstance(node, dict):
+            return
+        yield node
+        inputs = node.get('inputs', {})
+        value = next((inputs[name] for name in follow if is_link(inputs.get(name))), None)
+
+def comfyui_value(nodes, value, name):
+    """Resolve an input that may come from a primitive node to a plain value"""
+    for node in comfyui_chain(nodes, value, (name, 'value')):
+        inputs = node.get('inputs', {})
+        for key in (name, 'value', 'seed', 'int', 'float'):
+            if key in inputs and not is_link(inputs[key]):
+                return inputs[key]
+    return None if is_link(value) else value
+
+def comfyui_text(nodes, value, depth=0):
+    """Prompt text behind a conditioning input, joining combined conditionings"""
+    if isinstance(value, str):
+        return value
+    if not is_link(value) or depth > COMFYUI_MAX_DEPTH:
+        return ''
+    node = nodes.get(str(value[0]))
+    if not isinstance(node, dict):
+        return ''
+    inputs = node.get('inputs', {})
+    for key in COMFYUI_TEXT_INPUTS:
+        if key in inputs:
+            text = comfyui_text(nodes, inputs[key], depth + 1)
+            if text:
+                return text
+    parts = [comfyui_text(nodes, v, depth + 1) for k, v in inputs.items() if 'conditioning' in k]
+    return ', '.join(part for part in parts if part)
+
+def comfyui_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def pick_comfyui_sampler(nodes):
+    """The first-pass sampler node: one whose latent doesn't come from another sampler"""
+    samplers = [(node_id, node) for node_id, node in nodes.items()
+                if isinstance(node, dict) and 'sampler_name' in node.get('inputs', {})
+                and 'positive' in node['inputs']]
+    
+    def sort_key(item):
+        node_id = item[0]
+        return (0, int(node_id)) if node_id.isdigit() else (1, node_id)
+    
+    samplers.sort(key=sort_key)
+    for node_id, node in samplers:
+        upstream = comfyui_chain(nodes, node['inputs'].get('latent_image'), ('latent_image', 'samples'))
+        if not any('sampler_name' in n.get('inputs', {}) for n in upstream):
+            return node
+    return samplers[0][1] if samplers else None
+
+def comfyui_to_a1111(prompt_json):
+    """Convert a ComfyUI API-format prompt graph into an A1111 parameters string.
+    
+    The graph is decoded into an id -> node map once and only the nodes reached
+    from the sampler are looked at; the much larger UI 'workflow' chunk is never
+    parsed. Returns None if there is no usable sampler.
+    """
     try:
-        parts = params_str.split("Negative prompt:")
-        if len(parts) >= 2:
-            parsed['prompt'] = parts[0].strip()
-            rest = parts[1]
-            
-            settings_markers = ["Steps:", "Sampler:", "CFG"]
-            settings_start = len(rest)
-            for marker in settings_markers:
-                pos = rest.find(marker)
-                if pos != -1 and pos < settings_start:
-                    settings_start = pos
-            
-            parsed['negative'] = rest[:settings_start].strip()
-            settings = rest[settings_start:]
-        else:
-            parsed['prompt'] = params_str.strip()
-            settings = ""
+        nodes = json.loads(prompt_json)
+    except ValueError:
+        return None
+    if not isinstance(nodes, dict):
+        return None
+    sampler = pick_comfyui_sampler(nodes)
+    if sampler is None:
+        return None
+    inputs = sampler['inputs']
+    prompt = comfyui_text(nodes, inputs.get('positive')).strip()
+    negative = comfyui_text(nodes, inputs.get('negative')).strip()
+    
+    settings = {}
+    steps = comfyui_value(nodes, inputs.get('steps'), 'steps')
+    if steps is not None:
+        settings['Steps'] = comfyui_number(steps)
+    sampler_name = comfyui_value(nodes, inputs.get('sampler_name'), 'sampler_name')
+    if sampler_name:
+        name = COMFYUI_SAMPLERS.get(sampler_name, sampler_name)
+        scheduler = COMFYUI_SCHEDULERS.get(comfyui_value(nodes, inputs.get('scheduler'), 'scheduler'))
+        settings['Sampler'] = f"{name} {scheduler}" if scheduler else name
+    cfg = comfyui_value(nodes, inputs.get('cfg'), 'cfg')
+    if cfg is not None:
+        settings['CFG scale'] = comfyui_number(cfg)
+    seed_key = 'noise_seed' if 'noise_seed' in inputs else 'seed'
+    seed = comfyui_value(nodes, inputs.get(seed_key), seed_key)
+    if seed is not None:
+        settings['Seed'] = comfyui_number(seed)
+    for node in comfyui_chain(nodes, inputs.get('latent_image'), ('latent_image', 'samples')):
+        latent = node.get('inputs', {})
+        if 'width' in latent and 'height' in latent:
+            width = comfyui_value(nodes, latent['width'], 'width')
+            height = comfyui_value(nodes, latent['height'], 'height')
+            settings['Size'] = f"{comfyui_number(width)}x{comfyui_number(height)}"
+            break
+    
+    # Walk the model input back through LoRA loaders to the checkpoint
+    loras = []
+    for node in comfyui_chain(nodes, inputs.get('model'), ('model',)):
+        model_inputs = node.get('inputs', {})
+        checkpoint = model_inputs.get('ckpt_name') or model_inputs.get('unet_name')
+        if isinstance(checkpoint, str):
+            model = os.path.splitext(os.path.basename(checkpoint.replace('\\', '/')))[0]
+            model_hash = model_index.lookup(model)
+            if model_hash:
+                settings['Model hash'] = model_hash
+            settings['Model'] = model
+            break
+        if isinstance(model_inputs.get('lora_name'), str):
+            strength = comfyui_value(nodes, model_inputs.get('strength_model', 1), 'strength_model')
+            name = os.path.splitext(os.path.basename(model_inputs['lora_name'].replace('\\', '/')))[0]
+            loras.append((name, comfyui_number(strength)))
+    
+    denoise = comfyui_value(nodes, inputs.get('denoise'), 'denoise')
+    if isinstance(denoise, (int, float)) and denoise < 1:
+        settings['Denoising strength'] = comfyui_number(denoise)
+    for node in comfyui_chain(nodes, inputs.get('positive'), ('conditioning', 'clip')):
+        layer = node.get('inputs', {}).get('stop_at_clip_layer')
+        if isinstance(layer, int) and layer < -1:
+            settings['Clip skip'] = str(-layer)
+            break
+    
+    # A1111 keeps LoRAs as prompt tags; that is also what Lora hashes are matched on
+    extra = [f"<lora:{name}:{strength}>" for name, strength in reversed(loras) if f"<lora:{name}:" not in prompt]
+    if extra:
+        prompt = f"{prompt}, {' '.join(extra)}" if prompt else ' '.join(extra)
+    return format_a1111_params(prompt, negative, settings)
+
+def image_parameters(text):
+    """The A1111 parameters of an image: its own, or converted from a ComfyUI prompt graph"""
+    params = text.get('parameters', '')
+    if text.get('prompt') and not has_valid_parameters(params):
+        return comfyui_to_a1111(text['prompt']) or params
+    return params
+
+# The text chunks image_parameters() reads; pass as keys to skip the others
+PARAMETER_KEYS = ('parameters', 'prompt')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNK_TYPES = (b'tEXt', b'zTXt', b'iTXt')
+MAX_TEXT_BYTES = 64 * 1024 * 1024
+STREAM_BLOCK_SIZE = 256 * 1024
+
+def iter_png_chunks(png_bytes):
+    """Yield (chunk_type, start, end) for every chunk of a PNG byte string"""
+    if png_bytes[:8] != PNG_SIGNATURE:
+        raise ValueError('Not a PNG file')
+    offset = 8
+    total = len(png_bytes)
+    while offset + 12 <= total:
+        length, chunk_type = struct.unpack_from('>I4s', png_bytes, offset)
+        end = offset + 12 + length
+        if end > total:
+            raise ValueError(f'Truncated {chunk_type!r} chunk at offset {offset}')
+        yield chunk_type, offset, end
+        if chunk_type == b'IEND':
+            return
+        offset = end
+    raise ValueError('PNG has no IEND chunk')
+
+def skip_bytes(fp, count):
+    """Advance a file object by count bytes, seeking when possible"""
+    try:
+        fp.seek(count, 1)
+        return
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    while count > 0:
+        block = fp.read(min(count, 1 << 16))
+        if not block:
+            raise ValueError('Truncated file')
+        count -= len(block)
+
+def decompress_text(data):
+    """Inflate a zTXt/iTXt payload, refusing decompression bombs"""
+    inflater = zlib.decompressobj()
+    value = inflater.decompress(data, MAX_TEXT_BYTES)
+    if inflater.unconsumed_tail:
+        raise ValueError('Decompressed text chunk too large')
+    return value
+
+def decode_text_chunk(chunk_type, data):
+    """Decode a tEXt/zTXt/iTXt chunk body into (keyword, text)"""
+    keyword, sep, rest = bytes(data).partition(b'\0')
+    if not sep:
+        raise ValueError('Text chunk has no keyword separator')
+    key = keyword.decode('latin-1')
+    if chunk_type == b'tEXt':
+        return key, rest.decode('latin-1')
+    if chunk_type == b'zTXt':
+        return key, decompress_text(rest[1:]).decode('latin-1')
+    # iTXt: compression flag, method, language tag, translated keyword, text
+    compressed = rest[:1] == b'\1'
+    _lang, _, rest = rest[2:].partition(b'\0')
+    _translated, _, value = rest.partition(b'\0')
+    if compressed:
+        value = decompress_text(value)
+    return key, value.decode('utf-8', 'replace')
+
+def read_png_metadata(fp, check_crc=False, after_idat=False, keys=None):
+    """Read size and text chunks of a PNG without decoding any pixels.
+    
+    Only chunk headers, IHDR and text chunk bodies are read. The scan stops at
+    the first IDAT, like Pillow's Image.open; with after_idat=True the image
+    data is skipped instead so text chunks placed after it are found too.
+    With keys, only those text chunks are read and inflated; for the rest
+    (e.g. a multi-MB ComfyUI workflow) just the keyword is read and mapped
+    to None, so their presence is still known.
+    """
+    if fp.read(8) != PNG_SIGNATURE:
+        raise ValueError('Not a PNG file')
+    width = height = None
+    text = {}
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND' or (chunk_type == b'IDAT' and not after_idat):
+            break
+        if chunk_type != b'IHDR' and chunk_type not in TEXT_CHUNK_TYPES:
+            skip_bytes(fp, length + 4)
+            continue
         
-        # Parse settings
-        if settings:
-            steps_match = re.search(r'Steps:\s*(\d+)', settings)
-            if steps_match: parsed['steps'] = steps_match.group(1)
-            
-            sampler_match = re.search(r'Sampler:\s*([^,]+)', settings)
-            if sampler_match: parsed['sampler'] = sampler_match.group(1).strip()
-            
-            cfg_match = re.search(r'CFG scale:\s*([\d.]+)', settings)
-            if cfg_match: parsed['cfg'] = cfg_match.group(1)
-            
-            seed_match = re.search(r'Seed:\s*(\d+)', settings)
-            if seed_match: parsed['seed'] = seed_match.group(1)
-            
-            model_match = re.search(r'Model:\s*([^,]+)', settings)
-            if model_match: parsed['model'] = model_match.group(1).strip()
-            
-            hash_match = re.search(r'Model hash:\s*([a-fA-F0-9]+)', settings)
-            if hash_match: parsed['model_hash'] = hash_match.group(1)
-            
+        data = b''
+        if keys is not None and chunk_type != b'IHDR':
+            # Decide on the keyword before reading the body
+            data = fp.read(min(length, 80))
+            keyword = text_chunk_keyword(data)
+            if keyword not in keys:
+                text.setdefault(keyword, None)
+                skip_bytes(fp, length - len(data) + 4)
+                continue
+        data += fp.read(length - len(data))
+        crc = fp.read(4)
+        if len(crc) < 4:
+            raise ValueError(f'Truncated {chunk_type!r} chunk')
+        if check_crc and struct.unpack('>I', crc)[0] != zlib.crc32(data, zlib.crc32(chunk_type)):
+            raise ValueError(f'CRC mismatch in {chunk_type!r} chunk')
+        
+        if chunk_type == b'IHDR':
+            width, height = struct.unpack_from('>II', data)
+            continue
+        try:
+            key, value = decode_text_chunk(chunk_type, data)
+        except (ValueError, zlib.error) as e:
+            print(f"Skipping bad {chunk_type.decode()} chunk: {e}", file=sys.stderr)
+            continue
+        text[key] = value
+    
+    if width is None:
+        raise ValueError('PNG has no IHDR chunk')
+    return {'width': width, 'height': height, 'text': text}
+
+def peek_signature(fp):
+    """Return the first 12 bytes of fp without consuming them"""
+    if hasattr(fp, 'peek'):
+        return fp.peek(12)[:12]
+    start = fp.tell()
+    head = fp.read(12)
+    fp.seek(start)
+    return head
+
+def image_format(head):
+    """'png', 'jpeg' or 'webp' from the first 12 bytes of a file, else None"""
+    if head[:8] == PNG_SIGNATURE:
+        return 'png'
+    if head[:2] == JPEG_SOI:
+        return 'jpeg'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def read_image_metadata(fp, keys=None):
+    """Return {'width', 'height', 'text'} for an image file object.
+    
+    keys limits which PNG text chunks are read, see read_png_metadata().
+    """
+    fmt = image_format(peek_signature(fp))
+    if fmt is not None:
+        start = fp.tell() if fp.seekable() else None
+        try:
+            if fmt == 'png':
+                return read_png_metadata(fp, keys=keys)
+            if fmt == 'jpeg':
+                return read_jpeg_metadata(fp)
+            return read_webp_metadata(fp)
+        except ValueError as e:
+            if start is None:
+                raise
+            print(f"Chunk scan failed, falling back to Pillow: {e}", file=sys.stderr)
+            count(FALLBACKS, kind='pillow_metadata')
+            fp.seek(start)
+    
+    from PIL import Image
+    img = Image.open(fp)
+    text = {k: v for k, v in img.info.items() if isinstance(v, str)}
+    return {'width': img.width, 'height': img.height, 'text': text}
+
+def make_png_chunk(chunk_type, data):
+    """Build a complete PNG chunk (length, type, data, CRC)"""
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+def make_text_chunk(key, value):
+    """Build a tEXt chunk, or an uncompressed iTXt chunk if value isn't Latin-1"""
+    keyword = key.encode('latin-1')
+    try:
+        return make_png_chunk(b'tEXt', keyword + b'\0' + value.encode('latin-1'))
+    except UnicodeEncodeError:
+        # keyword, compression flag/method, empty language tag and translated keyword
+        return make_png_chunk(b'iTXt', keyword + b'\0\0\0\0\0' + value.encode('utf-8'))
+
+def text_chunk_keyword(chunk_data):
+    """Return the keyword of a tEXt/zTXt/iTXt chunk body"""
+    nul = bytes(chunk_data[:80]).find(b'\0')
+    return bytes(chunk_data[:nul if nul != -1 else 80]).decode('latin-1')
+
+def add_png_text_chunk(png_bytes, key, value):
+    """Splice a text chunk into a PNG without touching the image data.
+    
+    Existing chunks are copied byte-for-byte, any previous text chunk with the
+    same keyword is dropped and the new chunk is placed right before the first
+    IDAT, like A1111 writes it.
+    """
+    view = memoryview(png_bytes)
+    new_chunk = make_text_chunk(key, value)
+    parts = [PNG_SIGNATURE]
+    for chunk_type, start, end in iter_png_chunks(view):
+        if chunk_type in TEXT_CHUNK_TYPES and text_chunk_keyword(view[start + 8:end - 4]) == key:
+            continue
+        if chunk_type == b'IDAT' and new_chunk is not None:
+            parts.append(new_chunk)
+            new_chunk = None
+        parts.append(view[start:end])
+    if new_chunk is not None:
+        raise ValueError('PNG has no IDAT chunk')
+    return b''.join(parts)
+
+def read_exact(fp, count):
+    """Read exactly count bytes from fp"""
+    data = fp.read(count)
+    if len(data) != count:
+        raise ValueError('Truncated file')
+    return data
+
+def check_png_chunks(fp):
+    """Raise ValueError unless every chunk after fp's position is complete and
+    an IDAT comes before IEND. Only chunk headers are read; fp is seeked back.
+    """
+    start = fp.tell()
+    end = fp.seek(0, 2)
+    pos = start
+    seen_idat = False
+    try:
+        while True:
+            fp.seek(pos)
+            header = fp.read(8)
+            if len(header) < 8:
+                raise ValueError('Truncated file')
+            length, chunk_type = struct.unpack('>I4s', header)
+            pos += length + 12
+            if pos > end:
+                raise ValueError(f'Truncated {chunk_type!r} chunk')
+            if chunk_type == b'IDAT':
+                seen_idat = True
+            elif chunk_type == b'IEND':
+                if not seen_idat:
+                    raise ValueError('PNG has no IDAT chunk')
+                return
+    finally:
+        fp.seek(start)
+
+def iter_png_with_text(fp, key, value, block_size=STREAM_BLOCK_SIZE):
+    """Stream a PNG from fp with a text chunk spliced in, like add_png_text_chunk.
+    
+    Returns an iterator of the output pieces; image data is passed through in
+    blocks of at most block_size bytes, so memory use doesn't depend on the
+    image size. The chunk layout of a seekable fp is checked first, so a
+    broken PNG raises ValueError here rather than halfway through the output.
+    """
+    if fp.read(8) != PNG_SIGNATURE:
+        raise ValueError('Not a PNG file')
+    if fp.seekable():
+        check_png_chunks(fp)
+    return iter_spliced_png(fp, make_text_chunk(key, value), key, block_size)
+
+def iter_spliced_png(fp, new_chunk, key, block_size):
+    """Generator behind iter_png_with_text(), from just after the signature"""
+    yield PNG_SIGNATURE
+    while True:
+        header = read_exact(fp, 8)
+        length, chunk_type = struct.unpack('>I4s', header)
+        remaining = length + 4
+        if chunk_type in TEXT_CHUNK_TYPES:
+            # Only the keyword is needed to decide; big chunks are copied in blocks
+            start = read_exact(fp, min(remaining, 80))
+            remaining -= len(start)
+            if text_chunk_keyword(start) == key:
+                skip_bytes(fp, remaining)
+                continue
+            header += start
+        elif chunk_type == b'IDAT' and new_chunk is not None:
+            yield new_chunk
+            new_chunk = None
+        elif chunk_type == b'IEND' and new_chunk is not None:
+            raise ValueError('PNG has no IDAT chunk')
+        
+        yield header
+        while remaining:
+            block = read_exact(fp, min(remaining, block_size))
+            remaining -= len(block)
+            yield block
+        if chunk_type == b'IEND':
+            return
+
+# A1111 stores parameters in JPEG and WebP files as the EXIF UserComment,
+# UTF-16BE behind an 8-byte character code, the way piexif writes it
+JPEG_SOI = b'\xff\xd8'
+EXIF_HEADER = b'Exif\x00\x00'
+EXIF_IFD = 0x8769
+USER_COMMENT = 0x9286
+MAX_JPEG_SEGMENT = 65533  # payload bytes after the 2-byte segment length
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+WEBP_IMAGE_CHUNKS = (b'VP8X', b'ICCP', b'ANIM', b'ANMF', b'ALPH', b'VP8 ', b'VP8L')
+IMAGE_MIMETYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+IMAGE_SUFFIXES = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+
+def make_exif(parameters, old=None):
+    """EXIF block ("Exif\\0\\0" + TIFF) with parameters as its UserComment.
+    
+    Tags of an existing block are kept; one Pillow can't parse is replaced.
+    """
+    from PIL import Image
+    comment = b'UNICODE\x00' + parameters.encode('utf-16-be')
+    if old:
+        try:
+            exif = Image.Exif()
+            exif.load(old)
+            exif.get_ifd(EXIF_IFD)[USER_COMMENT] = comment
+            return exif.tobytes()
+        except Exception as e:  # Pillow raises all sorts of things on broken EXIF
+            print(f"Replacing unreadable EXIF: {e}", file=sys.stderr)
+    exif = Image.Exif()
+    exif.get_ifd(EXIF_IFD)[USER_COMMENT] = comment
+    return exif.tobytes()
+
+def decode_user_comment(comment):
+    """Decode an EXIF UserComment value (8-byte character code + text)"""
+    if isinstance(comment, str):
+        return comment.rstrip('\0')
+    code, body = comment[:8], comment[8:]
+    if code == b'UNICODE\x00':
+        # piexif always writes big-endian; some tools use the TIFF byte order
+        little = body[:1] != b'\0' and body[1:2] == b'\0'
+        text = body.decode('utf-16-le' if little else 'utf-16-be', 'replace')
+    elif code in (b'ASCII\x00\x00\x00', b'\x00' * 8):
+        text = body.decode('utf-8', 'replace')
+    else:
+        text = comment.decode('utf-8', 'replace')
+    return text.rstrip('\0')
+
+def exif_user_comment(data):
+    """The UserComment of an EXIF block as str, or None"""
+    from PIL import Image
+    try:
+        exif = Image.Exif()
+        exif.load(data)
+        comment = exif.get_ifd(EXIF_IFD).get(USER_COMMENT)
     except Exception as e:
-        print(f"Parse error: {e}")
+        print(f"Skipping bad EXIF: {e}", file=sys.stderr)
+        return None
+    return decode_user_comment(comment) if comment else None
+
+def iter_jpeg_segments(fp):
+    """Yield (marker, segment bytes) for the JPEG segments up to and including SOS.
     
-    return parsed
+    Only the headers are read; fp is left at the start of the scan data.
+    """
+    if fp.read(2) != JPEG_SOI:
+        raise ValueError('Not a JPEG file')
+    while True:
+        prefix, marker = read_exact(fp, 2)
+        while marker == 0xFF:  # fill bytes
+            marker = read_exact(fp, 1)[0]
+        if prefix != 0xFF:
+            raise ValueError('Bad JPEG marker')
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            yield marker, bytes((0xFF, marker))
+            continue
+        if marker == 0xD9:
+            raise ValueError('JPEG has no scan data')
+        length = read_exact(fp, 2)
+        size = struct.unpack('>H', length)[0]
+        if size < 2:
+            raise ValueError('Bad JPEG segment length')
+        yield marker, bytes((0xFF, marker)) + length + read_exact(fp, size - 2)
+        if marker == 0xDA:
+            return
 
-@app.route('/save-image', methods=['POST'])
-def save_image():
-    data = request.json
-    image_data = data['image']
-    parameters = data['parameters'].replace('\\n', '\n')
+def read_jpeg_metadata(fp):
+    """Read size and EXIF parameters of a JPEG from its header segments only"""
+    width = height = None
+    text = {}
+    for marker, segment in iter_jpeg_segments(fp):
+        if marker in JPEG_SOF_MARKERS and width is None:
+            height, width = struct.unpack_from('>HH', segment, 5)
+        elif marker == 0xE1 and segment[4:10] == EXIF_HEADER and 'parameters' not in text:
+            comment = exif_user_comment(segment[4:])
+            if comment:
+                text['parameters'] = comment
+    if width is None:
+        raise ValueError('JPEG has no frame header')
+    return {'width': width, 'height': height, 'text': text}
+
+def iter_jpeg_with_exif(fp, parameters, block_size=STREAM_BLOCK_SIZE, new_exif=None):
+    """Iterate a JPEG from fp with parameters as its EXIF UserComment.
+    
+    The header segments are rewritten up front, so errors surface before any
+    output; the scan data after them is copied through in blocks untouched.
+    new_exif is make_exif(parameters), if the caller has built it already.
+    """
+    segments = []
+    old_exif = None
+    for marker, segment in iter_jpeg_segments(fp):
+        if marker == 0xE1 and segment[4:10] == EXIF_HEADER:
+            old_exif = old_exif or segment[4:]
+            continue
+        segments.append((marker, segment))
+    
+    exif = make_exif(parameters, old_exif) if old_exif else new_exif or make_exif(parameters)
+    if len(exif) > MAX_JPEG_SEGMENT and old_exif:
+        exif = new_exif or make_exif(parameters)
+    if len(exif) > MAX_JPEG_SEGMENT:
+        raise ValueError('Parameters too long for a JPEG EXIF segment')
+    # A JFIF APP0 segment has to stay first
+    at = 1 if segments and segments[0][0] == 0xE0 else 0
+    segments.insert(at, (0xE1, b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif))
+    header = JPEG_SOI + b''.join(segment for _, segment in segments)
+    return itertools.chain([header], iter(lambda: fp.read(block_size), b''))
+
+def webp_canvas(fourcc, data):
+    """(width, height, has_alpha) from the start of a VP8X, VP8 or VP8L chunk body"""
+    if fourcc == b'VP8X':
+        flags, width, height = struct.unpack('<B3x3s3s', data[:10])
+        return (int.from_bytes(width, 'little') + 1, int.from_bytes(height, 'little') + 1, bool(flags & 0x10))
+    if fourcc == b'VP8 ':
+        if data[3:6] != b'\x9d\x01\x2a':
+            raise ValueError('Bad VP8 frame header')
+        width, height = struct.unpack_from('<HH', data, 6)
+        return width & 0x3FFF, height & 0x3FFF, False
+    if data[:1] != b'\x2f':
+        raise ValueError('Bad VP8L signature')
+    bits = struct.unpack_from('<I', data, 1)[0]
+    return (bits & 0x3FFF) + 1, (bits >> 14 & 0x3FFF) + 1, bool(bits >> 28 & 1)
+
+def read_webp_metadata(fp):
+    """Read size and EXIF parameters of a WebP, skipping over the image data"""
+    head = read_exact(fp, 12)
+    if image_format(head) != 'webp':
+        raise ValueError('Not a WebP file')
+    width = height = None
+    text = {}
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        fourcc, size = struct.unpack('<4sI', header)
+        padded = size + (size & 1)
+        if fourcc in (b'VP8X', b'VP8 ', b'VP8L') and width is None:
+            data = read_exact(fp, min(size, 10))
+            skip_bytes(fp, padded - len(data))
+            width, height, _alpha = webp_canvas(fourcc, data)
+        elif fourcc == b'EXIF':
+            comment = exif_user_comment(read_exact(fp, size))
+            skip_bytes(fp, padded - size)
+            if comment:
+                text['parameters'] = comment
+        else:
+            skip_bytes(fp, padded)
+    if width is None:
+        raise ValueError('WebP has no image data')
+    return {'width': width, 'height': height, 'text': text}
+
+def make_riff_chunk(fourcc, data):
+    """Build a RIFF chunk (fourcc, little-endian size, data, pad byte)"""
+    return fourcc + struct.pack('<I', len(data)) + data + b'\0' * (len(data) & 1)
+
+def iter_webp_with_exif(fp, parameters, block_size=STREAM_BLOCK_SIZE, new_exif=None):
+    """Iterate a WebP from a seekable fp with parameters as the EXIF UserComment.
+    
+    The chunk headers are scanned first so the new RIFF size is known before
+    anything is written; then the chunks are copied through in blocks, so the
+    bitstream is never held in memory or decoded. A simple (VP8/VP8L only)
+    file gets the VP8X header that EXIF needs. new_exif is as for
+    iter_jpeg_with_exif().
+    """
+    origin = fp.tell()
+    head = read_exact(fp, 12)
+    if image_format(head) != 'webp':
+        raise ValueError('Not a WebP file')
+    end = origin + 8 + struct.unpack_from('<I', head, 4)[0]
+    pieces = []  # bytes to write, or (offset, size) of a chunk to copy from fp
+    kinds = []
+    old_exif = None
+    offset = origin + 12
+    while offset + 8 <= end:
+        fp.seek(offset)
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        fourcc, size = struct.unpack('<4sI', header)
+        if offset + 8 + size > end:
+            raise ValueError(f'Truncated {fourcc!r} chunk at offset {offset - origin}')
+        if fourcc == b'EXIF':
+            old_exif = old_exif or read_exact(fp, size)
+        elif fourcc == b'VP8X' and not pieces:
+            vp8x = bytearray(read_exact(fp, size))
+            vp8x[0] |= 0x08  # EXIF flag
+            pieces.append(make_riff_chunk(fourcc, bytes(vp8x)))
+            kinds.append(fourcc)
+        else:
+            if not pieces:
+                width, height, alpha = webp_canvas(fourcc, read_exact(fp, min(size, 10)))
+                flags = 0x08 | (0x10 if alpha else 0)
+                pieces.append(make_riff_chunk(b'VP8X', struct.pack('<B3x', flags)
+                                              + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')))
+                kinds.append(b'VP8X')
+            pieces.append((offset, size))
+            kinds.append(fourcc)
+        offset += 8 + size + (size & 1)
+    if len(pieces) < 2:
+        raise ValueError('WebP has no image data')
+    
+    # EXIF goes after the image data and before XMP and unknown chunks
+    exif = make_exif(parameters, old_exif) if old_exif else new_exif or make_exif(parameters)
+    exif = exif[len(EXIF_HEADER):]
+    at = next((i for i, kind in enumerate(kinds) if kind not in WEBP_IMAGE_CHUNKS), len(kinds))
+    pieces.insert(at, make_riff_chunk(b'EXIF', exif))
+    
+    body_size = sum(len(piece) if isinstance(piece, bytes) else 8 + piece[1] + (piece[1] & 1) for piece in pieces)
+    
+    def copy_chunks():
+        yield b'RIFF' + struct.pack('<I', body_size + 4) + b'WEBP'
+        for piece in pieces:
+            if isinstance(piece, bytes):
+                yield piece
+                continue
+            chunk_offset, size = piece
+            fp.seek(chunk_offset)
+            remaining = 8 + size
+            while remaining:
+                block = read_exact(fp, min(remaining, block_size))
+                remaining -= len(block)
+                yield block
+            if size & 1:
+                yield b'\0'
+    
+    return copy_chunks()
+
+def add_webp_exif(webp_bytes, parameters, new_exif=None):
+    """Return WebP bytes with parameters as the EXIF UserComment, see iter_webp_with_exif()"""
+    return b''.join(iter_webp_with_exif(io.BytesIO(webp_bytes), parameters, new_exif=new_exif))
+
+def splice_format(head, parameters, new_exif=None):
+    """Format whose metadata can be edited in place, or None if a PNG re-encode is needed.
+    
+    new_exif is make_exif(parameters), if the caller has built it already.
+    """
+    fmt = image_format(head)
+    if fmt == 'jpeg' and len(new_exif or make_exif(parameters)) > MAX_JPEG_SEGMENT:
+        return None
+    return fmt
+
+def new_exif_for(head, parameters):
+    """make_exif(parameters) for a JPEG or WebP, built once for splice_format() and the splicer"""
+    return make_exif(parameters) if image_format(head) in ('jpeg', 'webp') else None
+
+def fixed_name(name, head, parameters):
+    """File name for the fixed copy: unchanged, or *_civitai.png if it becomes a PNG"""
+    if splice_format(head, parameters) or name.lower().endswith('.png'):
+        return name
+    return os.path.splitext(name)[0] + '_civitai.png'
+
+def iter_fixed_image(fp, parameters, block_size=STREAM_BLOCK_SIZE):
+    """Iterate the image with the given parameters, in its own format when possible.
+    
+    PNG, JPEG and WebP input is spliced in blocks of at most block_size bytes,
+    so memory use doesn't grow with the image; anything else is re-encoded as
+    PNG. The input's layout is checked and any re-encode happens right away
+    rather than lazily, so a broken image or a busy executor is reported
+    before a streamed response has started. Like write_parameters(), a file
+    that can't be spliced is re-encoded instead.
+    """
+    if not fp.seekable():
+        # Spool to disk, so the layout can be checked before anything is sent
+        spooled = tempfile.TemporaryFile()
+        for block in iter(lambda: fp.read(block_size), b''):
+            spooled.write(block)
+        spooled.seek(0)
+        fp = spooled
+    start = fp.tell()
+    head = peek_signature(fp)
+    new_exif = new_exif_for(head, parameters)
+    fmt = splice_format(head, parameters, new_exif)
+    if fmt is not None:
+        try:
+            if fmt == 'png':
+                return iter_png_with_text(fp, 'parameters', parameters, block_size)
+            if fmt == 'jpeg':
+                return iter_jpeg_with_exif(fp, parameters, block_size, new_exif)
+            return iter_webp_with_exif(fp, parameters, block_size, new_exif)
+        except ValueError as e:
+            print(f"Chunk splice failed, re-encoding: {e}", file=sys.stderr)
+            count(FALLBACKS, kind='reencode')
+            fp.seek(start)
+    else:
+        count(FALLBACKS, kind='non_png')
+    return [run_cpu_bound(reencode_png, fp.read(), parameters)]
+
+# Re-encoding compresses the pixels on png_threads threads, pigz-style, with
+# one of PNG_FILTERS on every row. 1 thread keeps Pillow's own encoder.
+PNG_FILTERS = ('none', 'sub', 'up')
+png_threads = int(os.environ.get('CIVITAI_FIXER_PNG_THREADS', '0')) or os.cpu_count() or 1
+png_level = int(os.environ.get('CIVITAI_FIXER_PNG_LEVEL', '6'))
+png_filter = os.environ.get('CIVITAI_FIXER_PNG_FILTER', 'up')
+PNG_BLOCK_BYTES = 1 << 20  # filtered bytes per compressed block
+DEFLATE_WINDOW = 32768
+ADLER_BASE = 65521
+png_executor = None
+
+def check_png_settings(level, method):
+    """Raise ValueError unless level is a zlib level and method one of PNG_FILTERS"""
+    if method not in PNG_FILTERS:
+        raise ValueError(f"Unknown PNG filter {method!r}, expected one of {', '.join(PNG_FILTERS)}")
+    if not 0 <= level <= 9:
+        raise ValueError(f"PNG compression level must be 0-9, got {level}")
+
+check_png_settings(png_level, png_filter)
+
+def adler32_combine(adler1, adler2, len2):
+    """Adler-32 of a + b from those of a and b (zlib's adler32_combine)"""
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = rem * sum1 % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem) % ADLER_BASE
+    return sum1 | sum2 << 16
+
+def filter_rows(raw, above, row_bytes, bpp, method):
+    """PNG-filter whole rows of 8-bit pixels; above is the row before the first.
+    
+    Sub and Up subtract byte-wise over all rows at once, using SWAR arithmetic
+    on Python integers, so no Python code runs per pixel.
+    """
+    n = len(raw)
+    if method == 'none':
+        filtered, tag = raw, b'\0'
+    else:
+        x = int.from_bytes(raw, 'big')
+        if method == 'up':
+            y, tag = int.from_bytes(above + raw[:n - row_bytes], 'big'), b'\2'
+        else:
+            # The first pixel of every row has nothing to its left
+            left = (bytes(bpp) + b'\xff' * (row_bytes - bpp)) * (n // row_bytes)
+            y, tag = x >> 8 * bpp & int.from_bytes(left, 'big'), b'\1'
+        high = int.from_bytes(b'\x80' * n, 'big')
+        # x - y in every byte: borrows stay inside the byte, then fix bit 7
+        diff = ((x | high) - (y & (high >> 7) * 0x7f)) ^ ((x ^ y ^ high) & high)
+        filtered = diff.to_bytes(n, 'big')
+    view = memoryview(filtered)
+    return b''.join(tag + view[i:i + row_bytes] for i in range(0, n, row_bytes))
+
+def deflate_block(data, window, level, last):
+    """(raw deflate of data, adler32 of data) for one block of the IDAT stream.
     
-    # Decode base64 image
-    header, encoded = image_data.split(',', 1)
-    image_bytes = base64.b64decode(encoded)
-    img = Image.open(io.BytesIO(image_bytes))
+    window is the tail of the previous block, used as the preset dictionary
+    so matches can reach back across the block boundary. Blocks other than the
+    last end with a sync flush, which pads to a byte boundary, so the outputs
+    concatenate into one valid deflate stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=window) if window else \
+        zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out, zlib.adler32(data)
+
+def encode_png_parallel(img, chunks, level, method, threads):
+    """Write an RGB/RGBA image as PNG, compressing the pixels on threads.
+    
+    Rows are filtered here, a strip at a time, while earlier strips are being
+    deflated on the pool (zlib releases the GIL); at most two strips per
+    thread are in flight. The blocks form a single zlib stream whose Adler-32
+    is combined from the per-block checksums; each block is written out as
+    its own IDAT chunk as soon as it is done.
+    """
+    global png_executor
+    check_png_settings(level, method)
+    if png_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        png_executor = ThreadPoolExecutor(max_workers=threads)
+    bpp = len(img.mode)
+    row_bytes = img.width * bpp
+    rows_per_block = max(1, PNG_BLOCK_BYTES // (row_bytes + 1))
+    
+    ihdr = struct.pack('>IIBBBBB', img.width, img.height, 8, 6 if img.mode == 'RGBA' else 2, 0, 0, 0)
+    out = io.BytesIO()
+    out.write(PNG_SIGNATURE + make_png_chunk(b'IHDR', ihdr) + b''.join(chunks))
+    # The zlib header for this level
+    out.write(make_png_chunk(b'IDAT', zlib.compress(b'', level)[:2]))
+    adler = 1
+    pending = collections.deque()
+    def collect():
+        nonlocal adler
+        size, future = pending.popleft()
+        data, block_adler = future.result()
+        adler = adler32_combine(adler, block_adler, size)
+        out.write(make_png_chunk(b'IDAT', data))
+    
+    above = bytes(row_bytes)
+    window = b''
+    for top in range(0, img.height, rows_per_block):
+        bottom = min(top + rows_per_block, img.height)
+        raw = img.crop((0, top, img.width, bottom)).tobytes()
+        block = filter_rows(raw, above, row_bytes, bpp, method)
+        last = bottom == img.height
+        pending.append((len(block), png_executor.submit(deflate_block, block, window, level, last)))
+        above = raw[-row_bytes:]
+        window = block[-DEFLATE_WINDOW:]
+        if len(pending) > 2 * threads:
+            collect()
+    while pending:
+        collect()
+    out.write(make_png_chunk(b'IDAT', struct.pack('>I', adler)))
+    out.write(make_png_chunk(b'IEND', b''))
+    return out.getvalue()
+
+def reencode_png(image_bytes, parameters):
+    """Fallback for non-PNG input: decode with Pillow and write a new PNG"""
+    from PIL import Image
+    from PIL.PngImagePlugin import PngInfo
+    with timed('open'):
+        img = Image.open(io.BytesIO(image_bytes))
+        img.load()
     
     # Convert to RGB/RGBA as needed
     if img.mode not in ('RGB', 'RGBA'):
-        img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+        with timed('convert'):
+            img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
     
     # Create PNG with metadata
-    pnginfo = PngInfo()
-    pnginfo.add_text("parameters", parameters)
-    
-    # Preserve other metadata
-    if hasattr(img, 'info'):
-        for key, value in img.info.items():
-            if key != 'parameters' and isinstance(value, str):
-                pnginfo.add_text(key, value)
+    with timed('pnginfo'):
+        text = {'parameters': parameters}
+        
+        # Preserve other metadata
+        if hasattr(img, 'info'):
+            for key, value in img.info.items():
+                if key != 'parameters' and isinstance(value, str):
+                    text[key] = value
     
     # Save to bytes
-    output = io.BytesIO()
-    img.save(output, format='PNG', pnginfo=pnginfo)
-    output.seek(0)
+    with timed('encode'):
+        if png_threads > 1 and img.width * img.height * len(img.mode) > PNG_BLOCK_BYTES:
+            chunks = [make_text_chunk(key, value) for key, value in text.items()]
+            if img.info.get('icc_profile'):
+                chunks.insert(0, make_png_chunk(b'iCCP', b'ICC Profile\0\0' + zlib.compress(img.info['icc_profile'])))
+            return encode_png_parallel(img, chunks, png_level, png_filter, png_threads)
+        pnginfo = PngInfo()
+        for key, value in text.items():
+            pnginfo.add_text(key, value)
+        output = io.BytesIO()
+        img.save(output, format='PNG', pnginfo=pnginfo, compress_level=png_level)
+    return output.getvalue()
+
+def write_parameters(image_bytes, parameters):
+    """Return image bytes carrying the given A1111 parameters string.
+    
+    PNG, JPEG and WebP keep their format; anything else becomes a PNG.
+    """
+    new_exif = new_exif_for(image_bytes[:12], parameters)
+    fmt = splice_format(image_bytes[:12], parameters, new_exif)
+    if fmt is not None:
+        try:
+            with timed('splice'):
+                if fmt == 'png':
+                    return add_png_text_chunk(image_bytes, 'parameters', parameters)
+                if fmt == 'jpeg':
+                    return b''.join(iter_jpeg_with_exif(io.BytesIO(image_bytes), parameters, new_exif=new_exif))
+                return add_webp_exif(image_bytes, parameters, new_exif)
+        except ValueError as e:
+            print(f"Chunk splice failed, re-encoding: {e}", file=sys.stderr)
+            count(FALLBACKS, kind='reencode')
+    else:
+        count(FALLBACKS, kind='non_png')
+    return run_cpu_bound(reencode_png, image_bytes, parameters)
+
+@web.route('/save-image', methods=['POST'])
+def save_image():
+    from flask import jsonify, request, send_file
+    if not request.is_json:
+        return save_image_stream()
+    
+    data = request.json
+    parameters = data['parameters'].replace('\\n', '\n')
+    if 'path' in data:
+        return save_library_image(data['path'], parameters, data.get('mode', 'sibling'))
+    image_bytes = upload_cache.get(data['handle']) if data.get('handle') else None
+    if image_bytes is None:
+        if 'image' not in data:
+            return jsonify({'error': CACHE_MISS_ERROR}), 409
+        image_bytes = decode_data_url(data['image'])
+        if image_bytes is None:
+            return jsonify({'error': DATA_URL_ERROR}), 400
+    
+    try:
+        fixed = write_parameters(image_bytes, parameters)
+    except (ValueError, OSError):
+        # Neither spliceable nor readable by Pillow
+        return jsonify({'error': UNREADABLE_IMAGE_ERROR}), 400
+    fmt = image_format(fixed[:12])
+    output = io.BytesIO(fixed)
+    
+    return send_file(output, mimetype=IMAGE_MIMETYPES[fmt], as_attachment=True, 
+                     download_name='fixed_image' + IMAGE_SUFFIXES[fmt])
+
+def save_image_stream():
+    """Binary variant of /save-image that streams the fixed image back"""
+    from flask import Response, jsonify, request
+    multipart = request.mimetype == 'multipart/form-data'
+    fields = request.form if multipart else request.args
+    cached = upload_cache.get(fields['handle']) if fields.get('handle') else None
+    if cached is not None:
+        fp = io.BytesIO(cached)
+    elif ('image' in request.files) if multipart else request.content_length:
+        fp, fields = request_image_stream()
+    else:
+        return jsonify({'error': CACHE_MISS_ERROR}), 409
+    parameters = fields['parameters'].replace('\\n', '\n')
+    
+    try:
+        blocks = iter_fixed_image(fp, parameters)
+    except (ValueError, OSError):
+        # Neither spliceable nor readable by Pillow
+        fp.close()
+        return jsonify({'error': UNREADABLE_IMAGE_ERROR}), 400
+    blocks = iter(blocks)
+    first = next(blocks, b'')
+    fmt = image_format(first[:12]) or 'png'
+    filename = 'fixed_image' + IMAGE_SUFFIXES[fmt]
+    response = Response(itertools.chain([first], blocks), mimetype=IMAGE_MIMETYPES[fmt],
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
+    response.call_on_close(fp.close)
+    return response
+
+# Local library mode: with a root directory configured (--library or
+# $CIVITAI_FIXER_LIBRARY) the UI browses the images below it, and /load-image
+# and /save-image take a path instead of an upload. Only for servers running
+# on the same machine as the images; anything outside the root is refused.
+library_root = None
+
+class LibraryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+@web.errorhandler(LibraryError)
+def library_error(e):
+    from flask import jsonify
+    return jsonify({'error': str(e)}), e.status
+
+def configure_library(path):
+    global library_root
+    library_root = os.path.realpath(path) if path else None
+
+configure_library(os.environ.get('CIVITAI_FIXER_LIBRARY'))
+
+def library_path(rel):
+    """Absolute path of rel below the library root, with symlinks resolved"""
+    if library_root is None:
+        raise LibraryError(404, 'Library mode is off, start the server with --library DIR')
+    # rel may come straight from a JSON body
+    if not isinstance(rel, str) or '\0' in rel:
+        raise LibraryError(400, 'Invalid path')
+    path = os.path.realpath(os.path.join(library_root, rel))
+    # realpath resolves '..' and symlinks, so this also catches links leading out
+    if not in_library(path):
+        raise LibraryError(403, 'Path is outside the library')
+    return path
+
+def library_file(rel):
+    path = library_path(rel)
+    if not os.path.isfile(path) or not path.lower().endswith(IMAGE_EXTENSIONS):
+        raise LibraryError(404, f'No image at {rel!r}')
+    return path
+
+def library_relpath(path):
+    return '' if path == library_root else os.path.relpath(path, library_root).replace(os.sep, '/')
+
+def in_library(path):
+    return os.path.commonpath([library_root, os.path.realpath(path)]) == library_root
+
+@web.route('/library')
+def library():
+    """List the folders and images in one directory of the library"""
+    from flask import jsonify, request
+    path = library_path(request.args.get('dir', ''))
+    dirs, files = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or entry.is_symlink() and not in_library(entry.path):
+                    continue
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    stat = entry.stat()
+                    files.append({'name': entry.name, 'size': stat.st_size, 'mtime': stat.st_mtime})
+    except (FileNotFoundError, NotADirectoryError):
+        raise LibraryError(404, 'No such folder')
+    rel = library_relpath(path)
+    return jsonify({'dir': rel, 'parent': None if not rel else library_relpath(os.path.dirname(path)),
+                    'dirs': sorted(dirs, key=str.lower), 'files': sorted(files, key=lambda f: f['name'].lower())})
+
+@web.route('/library/file')
+def library_image():
+    """The image itself, for the UI preview; sent from disk without buffering"""
+    from flask import request, send_file
+    return send_file(library_file(request.args.get('path', '')), conditional=True, max_age=0)
+
+def load_library_image(rel):
+    """/load-image for a library path: only the metadata is read, not the pixels"""
+    from flask import jsonify
+    path = library_file(rel)
+    with open(path, 'rb') as fp:
+        meta = read_upload_metadata(fp)
+    if meta is None:
+        return jsonify({'error': UNREADABLE_IMAGE_ERROR}), 400
+    result = build_load_result(meta)
+    result['path'] = library_relpath(path)
+    return jsonify(result)
+
+def save_library_image(rel, parameters, mode):
+    """/save-image for a library path: write in place or next to the original.
+    
+    mode 'inplace' replaces the file (or writes *_civitai.png beside it if it
+    has to become a PNG), 'sibling' writes *_civitai.<ext>. Either way the file
+    is streamed to a temporary name and renamed, like `fix`.
+    """
+    from flask import jsonify
+    src = library_file(rel)
+    with open(src, 'rb') as fp:
+        head = peek_signature(fp)
+    name = os.path.basename(src)
+    if mode == 'inplace':
+        name = fixed_name(name, head, parameters)
+    elif mode == 'sibling':
+        fmt = splice_format(head, parameters) or 'png'
+        name = os.path.splitext(name)[0] + '_civitai' + IMAGE_SUFFIXES[fmt]
+    else:
+        raise LibraryError(400, f'Unknown mode {mode!r}')
+    dst = os.path.join(os.path.dirname(src), name)
+    write_fixed_file(src, dst, parameters)
+    return jsonify({'path': library_relpath(dst), 'size': os.path.getsize(dst)})
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+# Same values the UI's "Auto-fill Valid Metadata" button uses
+DEFAULT_METADATA = {
+    'prompt': 'AI generated image',
+    'negative': '',
+    'steps': '20',
+    'sampler': 'DPM++ 2M Karras',
+    'cfg': '7',
+    'model': 'sd_xl_base_1.0',
+    'model_hash': 'be9edd61',
+    'clip_skip': '1',
+}
+
+def has_valid_parameters(params_str):
+    """Check whether a parameters string has an A1111 settings line"""
+    if not params_str or not params_str.strip():
+        return False
+    prompt, negative, settings = split_a1111_params(params_str)
+    return 'Steps' in settings and 'Sampler' in settings
+
+def fill_defaults(parsed, width, height, defaults=None):
+    """Complete parsed metadata with auto-fill defaults, like autoFillMetadata()"""
+    values = dict(DEFAULT_METADATA)
+    values.update(defaults or {})
+    values.update({k: v for k, v in parsed.items() if v})
+    if not values.get('seed') or values['seed'] == '-1':
+        values['seed'] = str(random.randrange(4294967295))
+    if not parsed.get('model_hash'):
+        # The default hash only belongs to the default model; any other model
+        # gets its indexed hash or no hash at all, never a wrong one
+        fallback = dict(DEFAULT_METADATA, **(defaults or {}))
+        values['model_hash'] = model_index.lookup(values['model']) or (
+            fallback['model_hash'] if values['model'] == fallback['model'] else '')
+    settings = values.get('settings', {})
+    if 'Lora hashes' not in settings:
+        lora_hashes = model_index.lora_hashes(values['prompt'])
+        if lora_hashes:
+            values['settings'] = dict(settings, **{'Lora hashes': lora_hashes})
+    values.setdefault('width', str(width))
+    values.setdefault('height', str(height))
+    return values
+
+def parameters_for(meta, overrides=None, defaults=None):
+    """Parameters string for an image: existing metadata + overrides + defaults.
+    
+    defaults (e.g. from a folder's civitai_defaults.json) replace the built-in
+    auto-fill values but, unlike overrides, never beat existing metadata.
+    """
+    overrides = overrides or {}
+    if overrides.get('parameters'):
+        return overrides['parameters']
+    params = image_parameters(meta['text'])
+    parsed = parse_a1111_params(params) if params else {}
+    parsed.update(overrides)
+    return build_parameters(fill_defaults(parsed, meta['width'], meta['height'], defaults))
+
+def build_parameters(values):
+    """Build an A1111 parameters string, like buildMetadata() in the UI"""
+    params = values['prompt'].strip()
+    negative = values.get('negative', '').strip()
+    if negative:
+        params += f"\nNegative prompt: {negative}"
+    
+    settings = [
+        f"Steps: {values['steps']}",
+        f"Sampler: {values['sampler']}",
+        f"CFG scale: {values['cfg']}",
+        f"Seed: {values['seed']}",
+        f"Size: {values['width']}x{values['height']}",
+    ]
+    if values.get('model'):
+        settings.append(f"Model: {values['model']}")
+    if values.get('model_hash'):
+        settings.append(f"Model hash: {values['model_hash']}")
+    if str(values.get('clip_skip', '1')) != '1':
+        settings.append(f"Clip skip: {values['clip_skip']}")
+    
+    # Keep settings the form has no field for (Hires, LoRA hashes, VAE, ...)
+    for key, value in values.get('settings', {}).items():
+        if key not in LEGACY_KEYS and key != 'Size':
+            settings.append(f"{key}: {quote_setting(value)}")
+    
+    return params + '\n' + ', '.join(settings)
+
+def write_fixed_file(src, dst, parameters):
+    """Write src to dst with new parameters, atomically via a temp file"""
+    tmp = f"{dst}.tmp{os.getpid()}"
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    try:
+        with open(src, 'rb') as fp, open(tmp, 'wb') as out:
+            for block in iter_fixed_image(fp, parameters):
+                out.write(block)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def iter_fix_file(src, parameters=None, block_size=STREAM_BLOCK_SIZE):
+    """Yield the image at src with new parameters, block by block.
+    
+    PNG, JPEG and WebP are spliced without decoding any pixels, so memory use
+    stays at a few blocks whatever the image size. Without parameters the
+    image's own metadata is completed with the auto-fill defaults, like `fix`.
+    """
+    with open(src, 'rb') as fp:
+        if parameters is None:
+            parameters = parameters_for(read_image_metadata(fp, PARAMETER_KEYS))
+            fp.seek(0)
+        yield from iter_fixed_image(fp, parameters, block_size)
+
+def fix_file(src, dst, parameters=None):
+    """Write src to dst with new parameters in constant memory; returns the parameters.
+    
+    dst may be src itself: it is replaced atomically once the copy is complete.
+    """
+    if parameters is None:
+        with open(src, 'rb') as fp:
+            parameters = parameters_for(read_image_metadata(fp, PARAMETER_KEYS))
+    write_fixed_file(src, dst, parameters)
+    return parameters
+
+def fixed_path(src, root, out_dir):
+    """Where the fixed copy of src goes: in place, or mirrored under out_dir"""
+    return src if out_dir is None else os.path.join(out_dir, os.path.relpath(src, root))
+
+def fix_one(task):
+    """Pool worker: fix a single file and return (src, status, bytes read)"""
+    src, dst, force, defaults = task
+    try:
+        stat = os.stat(src)
+        size = stat.st_size
+        if not force and dst != src and os.path.exists(dst) and os.path.getmtime(dst) >= stat.st_mtime:
+            return src, 'skipped', 0
+        with open(src, 'rb') as fp:
+            head = peek_signature(fp)
+            meta = read_image_metadata(fp, PARAMETER_KEYS)
+        params = meta['text'].get('parameters', '')
+        if not force and has_valid_parameters(params):
+            return src, 'skipped', size
+        parameters = parameters_for(meta, defaults=defaults)
+        write_fixed_file(src, fixed_name(dst, head, parameters), parameters)
+        return src, 'fixed', size
+    except Exception as e:
+        return src, f'error: {e}', 0
+
+def iter_image_files(roots):
+    """Yield (path, root) for every supported image below the given directories"""
+    for root in roots:
+        if os.path.isfile(root):
+            yield root, os.path.dirname(root)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith(IMAGE_EXTENSIONS) and '_civitai.' not in name:
+                    yield os.path.join(dirpath, name), root
+
+def run_fix(args):
+    """Entry point of the `fix` command"""
+    done = set()
+    if args.journal and os.path.exists(args.journal):
+        with open(args.journal, encoding='utf-8') as f:
+            done = {line.rstrip('\n') for line in f}
+    
+    tasks = []
+    defaults = FolderDefaults()
+    for src, root in iter_image_files(args.dirs):
+        src = os.path.abspath(src)
+        if src in done:
+            continue
+        out_dir = args.out
+        if out_dir is not None and len(args.dirs) > 1:
+            out_dir = os.path.join(out_dir, os.path.basename(os.path.normpath(root)))
+        tasks.append((src, fixed_path(src, root, out_dir), args.force, defaults.get(src, root)))
+    
+    model_index.scan_configured()
+    print(f"{len(tasks)} files to check ({len(done)} already done)")
+    counts = run_tasks(fix_one, tasks, args.workers, args.journal)
+    return 1 if counts['error'] else 0
+
+def run_tasks(worker, tasks, workers, journal_path=None, chunksize=8):
+    """Run (src, status, bytes read) workers over tasks in a process pool with progress output"""
+    total = len(tasks)
+    counts = {'fixed': 0, 'skipped': 0, 'error': 0}
+    nbytes = 0
+    start = last_report = time.monotonic()
+    journal = open(journal_path, 'a', encoding='utf-8') if journal_path else None
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for i, (src, status, size) in enumerate(pool.imap_unordered(worker, tasks, chunksize=chunksize), 1):
+                nbytes += size
+                if status.startswith('error'):
+                    counts['error'] += 1
+                    print(f"  {src}: {status}", file=sys.stderr)
+                else:
+                    counts[status] += 1
+                    if journal:
+                        journal.write(src + '\n')
+                now = time.monotonic()
+                if now - last_report >= 1 or i == total:
+                    last_report = now
+                    elapsed = max(now - start, 1e-9)
+                    print(f"  {i}/{total} files, {i / elapsed:.0f} files/s, "
+                          f"{nbytes / elapsed / 1e6:.1f} MB/s", flush=True)
+    finally:
+        if journal:
+            journal.close()
+    
+    elapsed = time.monotonic() - start
+    print(f"Done in {elapsed:.1f}s: {counts['fixed']} fixed, {counts['skipped']} already valid, "
+          f"{counts['error']} failed")
+    return counts
+
+FOLDER_DEFAULTS_NAME = 'civitai_defaults.json'
+
+class FolderDefaults:
+    """Default metadata from civitai_defaults.json files, cached per directory.
+    
+    Files in the image's folder and every parent up to the root are merged,
+    the closest one winning. Same keys as a /batch manifest entry.
+    """
+    
+    def __init__(self):
+        self.cache = {}
+    
+    def load(self, directory):
+        path = os.path.join(directory, FOLDER_DEFAULTS_NAME)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return {}
+        cached = self.cache.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path, encoding='utf-8') as f:
+                values = {k: str(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Ignoring {path}: {e}", file=sys.stderr)
+            values = {}
+        self.cache[directory] = (mtime, values)
+        return values
+    
+    def get(self, path, root):
+        """Merged defaults for an image below root"""
+        root = os.path.abspath(root)
+        directory = os.path.dirname(os.path.abspath(path))
+        chain = [directory]
+        while directory != root and directory.startswith(root + os.sep):
+            directory = os.path.dirname(directory)
+            chain.append(directory)
+        values = {}
+        for directory in reversed(chain):
+            values.update(self.load(directory))
+        return values or None
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class InotifyWatcher:
+    """Reports files below some folders as they are closed after writing or moved in"""
+    
+    def __init__(self, roots):
+        import ctypes
+        self.get_errno = ctypes.get_errno
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), 'inotify_init1 failed')
+        self.roots = roots
+        self.dirs = {}
+        self.rescan = False
+        for root in roots:
+            self.watch_tree(root)
+    
+    def watch_tree(self, top):
+        """Watch top and its subfolders; returns the files already in them"""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                print(f"Cannot watch {dirpath}: {os.strerror(self.get_errno())}", file=sys.stderr)
+                continue
+            self.dirs[wd] = dirpath
+            found.extend(os.path.join(dirpath, name) for name in filenames)
+        return found
+    
+    def changes(self, timeout):
+        """Paths written or moved in within timeout seconds, or None after a queue overflow"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 1 << 20)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0'))
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; the caller has to rescan everything
+                return None
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have landed in the new folder before it was watched
+                    paths.extend(self.watch_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(path)
+        return paths
+    
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Fallback for systems or file systems without inotify: rescans every interval seconds"""
+    
+    def __init__(self, roots, interval):
+        self.roots = roots
+        self.interval = interval
+        self.stats = {}
+        self.next_scan = 0
+        self.changes(0)
+    
+    def changes(self, timeout):
+        """Paths that are new or changed since the previous scan"""
+        delay = self.next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(delay, 0))
+        self.next_scan = time.monotonic() + self.interval
+        stats = {}
+        paths = []
+        for path, size, mtime in iter_image_stats(self.roots):
+            stats[path] = (size, mtime)
+            if self.stats.get(path) != (size, mtime):
+                paths.append(path)
+        self.stats = stats
+        return paths
+    
+    def close(self):
+        pass
+
+class WatchState:
+    """(path, size, mtime) of every file the watcher has handled, kept on disk.
+    
+    A file whose size and mtime still match is not looked at again, which is
+    also how the watcher recognises its own in-place writes.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.seen = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        name, size, mtime = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    self.seen[name] = (size, mtime)
+        # Compact the log: one line per file that still exists
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for name, (size, mtime) in self.seen.items():
+                if os.path.exists(name):
+                    f.write(json.dumps([name, size, mtime]) + '\n')
+        os.replace(tmp, path)
+        self.log = open(path, 'a', encoding='utf-8')
+    
+    def is_done(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return True
+        return self.seen.get(path) == (stat.st_size, stat.st_mtime_ns)
+    
+    def record(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self.seen[path] = (stat.st_size, stat.st_mtime_ns)
+            self.log.write(json.dumps([path, stat.st_size, stat.st_mtime_ns]) + '\n')
+            self.log.flush()
+    
+    def close(self):
+        self.log.close()
+
+def default_watch_state():
+    return os.environ.get('CIVITAI_FIXER_WATCH_STATE') or os.path.join(
+        Path.home(), '.cache', 'civitai_metadata_fixer', 'watch_state.jsonl')
+
+def run_watch(args):
+    """Entry point of the `watch` command: fix images as they appear in folders"""
+    roots = [os.path.abspath(d) for d in args.dirs]
+    state = WatchState(args.state or default_watch_state())
+    defaults = FolderDefaults()
+    watcher = None
+    if not args.poll:
+        try:
+            watcher = InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}), polling instead", file=sys.stderr)
+    if watcher is None:
+        watcher = PollingWatcher(roots, args.interval)
+    model_index.scan_configured()
+    
+    # Files that appeared while we weren't running
+    pending = {}
+    now = time.monotonic()
+    for path, size, mtime in iter_image_stats(roots):
+        pending[path] = now
+    
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stopping.set())
+    
+    # Workers plus queued tasks; submitting blocks once they are all taken
+    slots = threading.BoundedSemaphore(args.workers + args.queue)
+    counts = {'fixed': 0, 'skipped': 0, 'error': 0}
+    
+    def done(result):
+        src, status, size = result
+        state.record(src)
+        slots.release()
+        kind = 'error' if status.startswith('error') else status
+        counts[kind] += 1
+        if kind != 'skipped':
+            print(f"{src}: {status}", file=sys.stderr if kind == 'error' else sys.stdout, flush=True)
+    
+    def root_of(path):
+        return next((root for root in roots if path.startswith(root + os.sep)), roots[0])
+    
+    def acquire_slot():
+        while not slots.acquire(timeout=1):
+            if stopping.is_set():
+                return False
+        return True
+    
+    print(f"Watching {len(roots)} folders with {watcher.__class__.__name__}, "
+          f"{len(pending)} existing files to check")
+    with multiprocessing.Pool(args.workers) as pool:
+        try:
+            while not stopping.is_set():
+                now = time.monotonic()
+                due = [path for path, last in pending.items() if now - last >= args.settle]
+                for path in due:
+                    del pending[path]
+                    name = os.path.basename(path)
+                    if not name.lower().endswith(IMAGE_EXTENSIONS) or '_civitai.' in name or state.is_done(path):
+                        continue
+                    if not acquire_slot():
+                        break
+                    root = root_of(path)
+                    task = (path, fixed_path(path, root, args.out), args.force, defaults.get(path, root))
+                    pool.apply_async(fix_one, (task,), callback=done,
+                                     error_callback=lambda e: slots.release())
+                
+                # Sleep until the next pending file settles or something happens
+                timeout = args.settle - (now - min(pending.values())) if pending else 1
+                try:
+                    changed = watcher.changes(max(timeout, 0.01))
+                except InterruptedError:
+                    continue
+                now = time.monotonic()
+                if changed is None:
+                    print("Watch queue overflowed, rescanning", file=sys.stderr)
+                    changed = [path for path, size, mtime in iter_image_stats(roots)]
+                for path in changed:
+                    # Every new event restarts the file's settle timer
+                    pending[path] = now
+        finally:
+            print("Stopping, waiting for files in progress...", flush=True)
+            pool.close()
+            pool.join()
+            watcher.close()
+            state.close()
+    print(f"{counts['fixed']} fixed, {counts['skipped']} already valid, {counts['error']} failed")
+    return 0
+
+MANIFEST_NAMES = ('manifest.json', 'manifest.jsonl', 'manifest.csv')
+
+class ChunkSink(io.RawIOBase):
+    """Unseekable write target that collects bytes until they are drained"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+def manifest_rows(data, name):
+    """Rows of a JSON, JSON Lines or CSV manifest as dicts of strings.
+    
+    JSON manifests map file names to override dicts; JSONL and CSV manifests
+    have one row per image with the file name under 'file'. Override keys are
+    the same as parse_a1111_params() returns, or 'parameters' for a full string.
+    """
+    if name.endswith('.csv'):
+        rows = csv.DictReader(io.StringIO(data))
+    elif name.endswith('.jsonl'):
+        rows = (json.loads(line) for line in data.splitlines() if line.strip())
+    else:
+        rows = (dict(values, file=file) for file, values in json.loads(data).items())
+    return [{k: str(v) for k, v in row.items() if k and v not in (None, '')} for row in rows]
+
+def load_manifest(fp, name):
+    """Read per-file overrides from a manifest, see manifest_rows()"""
+    rows = manifest_rows(fp.read().decode('utf-8-sig'), name)
+    return {row.pop('file'): row for row in rows if 'file' in row}
+
+def iter_batch_zip(entries, manifest):
+    """Build the output archive for (name, open_entry) pairs, block by block.
+    
+    open_entry() returns a fresh readable stream of the entry each time it is
+    called. Only one entry is open at a time and every block written to the
+    archive is yielded right away, so memory stays bounded by the block size.
+    """
+    sink = ChunkSink()
+    errors = []
+    started = False
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as out:
+        for name, open_entry, size in entries:
+            overrides = manifest.get(name) or manifest.get(os.path.basename(name))
+            try:
+                with open_entry() as fp:
+                    meta = read_image_metadata(fp, PARAMETER_KEYS)
+                if not overrides and has_valid_parameters(meta['text'].get('parameters')):
+                    # Already fine, copy the entry through unchanged
+                    parameters = None
+                else:
+                    parameters = parameters_for(meta, overrides)
+                
+                with open_entry() as fp:
+                    if parameters is None:
+                        blocks, out_name = iter(lambda: fp.read(STREAM_BLOCK_SIZE), b''), name
+                    else:
+                        # The input is checked (and re-encoded if need be) here,
+                        # so a broken image never leaves a partial entry behind
+                        while True:
+                            try:
+                                blocks = iter(iter_fixed_image(fp, parameters))
+                                break
+                            except ServiceBusy:
+                                # Until something is sent, /batch can still answer 503;
+                                # after that the client is waiting, so wait for an encoder
+                                if not started:
+                                    raise
+                                time.sleep(RETRY_AFTER_SECONDS)
+                                fp.seek(0)
+                        first = next(blocks, b'')
+                        blocks = itertools.chain([first], blocks)
+                        out_name = name
+                        if image_format(first[:12]) == 'png' and not name.lower().endswith('.png'):
+                            out_name = os.path.splitext(name)[0] + '_civitai.png'
+                    with out.open(out_name, 'w', force_zip64=size > 1 << 30) as dst:
+                        for block in blocks:
+                            dst.write(block)
+                            started = True
+                            yield sink.drain()
+            except ServiceBusy:
+                raise
+            except Exception as e:
+                errors.append(f"{name}: {e or type(e).__name__}")
+            started = True
+            yield sink.drain()
+        if errors:
+            out.writestr('batch_errors.txt', '\n'.join(errors) + '\n')
+    yield sink.drain()
+
+def zip_entries(archive):
+    """(name, open_entry, size) for the images in an uploaded ZIP"""
+    for info in archive.infolist():
+        if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+            yield info.filename, lambda info=info: archive.open(info), info.file_size
+
+def upload_entries(files):
+    """(name, open_entry, size) for individually uploaded files"""
+    for name, fp in files:
+        fp.seek(0, 2)
+        size = fp.tell()
+        
+        def open_entry(fp=fp):
+            fp.seek(0)
+            return contextlib.nullcontext(fp)
+        yield name, open_entry, size
+
+@web.route('/batch', methods=['POST'])
+def batch():
+    """Fix a ZIP archive or several uploaded files and stream back a ZIP.
+    
+    Send either a ZIP as the raw body / 'archive' form file, or any number of
+    images as 'image' form files. A manifest.json(l) inside the archive or as a
+    'manifest' form file gives per-file overrides.
+    """
+    from flask import Response, jsonify, request
+    owned = []
+    manifest = {}
+    if request.mimetype == 'multipart/form-data':
+        if 'manifest' in request.files:
+            upload = request.files['manifest']
+            manifest = load_manifest(upload.stream, upload.filename or 'manifest.json')
+        if 'archive' in request.files:
+            archive_fp = take_upload(request.files['archive'])
+        else:
+            files = [(upload.filename, take_upload(upload)) for upload in request.files.getlist('image')]
+            owned.extend(fp for _, fp in files)
+            archive_fp = None
+    else:
+        # zipfile needs to seek to the central directory, so spool the body to disk
+        archive_fp = tempfile.TemporaryFile()
+        for block in iter(lambda: request.stream.read(STREAM_BLOCK_SIZE), b''):
+            archive_fp.write(block)
     
-    return send_file(output, mimetype='image/png', as_attachment=True, 
-                     download_name='fixed_image.png')
+    if archive_fp is not None:
+        owned.append(archive_fp)
+        try:
+            archive = zipfile.ZipFile(archive_fp)
+        except zipfile.BadZipFile:
+            for fp in owned:
+                fp.close()
+            return jsonify({'error': 'The body is not a ZIP archive'}), 400
+        for name in MANIFEST_NAMES:
+            if name in archive.namelist():
+                with archive.open(name) as fp:
+                    manifest.update(load_manifest(fp, name))
+        entries = zip_entries(archive)
+    else:
+        entries = upload_entries(files)
+    
+    body = iter_batch_zip(entries, manifest)
+    try:
+        # Run up to the first output, so a busy server can still answer 503
+        first = next(body, b'')
+    except BaseException:
+        for fp in owned:
+            fp.close()
+        raise
+    response = Response(itertools.chain([first], body), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=fixed_images.zip'})
+    response.call_on_close(body.close)
+    for fp in owned:
+        response.call_on_close(fp.close)
+    return response
+
+MODEL_EXTENSIONS = ('.safetensors', '.ckpt', '.pt', '.pth')
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+LORA_TAG_RE = re.compile(r'<lora:([^:>]+)')
+
+def env_dirs(name):
+    """Directories listed in an os.pathsep separated environment variable"""
+    return [d for d in os.environ.get(name, '').split(os.pathsep) if d]
+
+def hash_model_file(path):
+    """Compute the A1111 hashes of a model file in one sequential read.
+    
+    Returns the full SHA-256 (AutoV2 is its first 10 characters), the legacy
+    8-character hash of the 64 KiB at offset 1 MiB and, for safetensors, the
+    "addnet" SHA-256 of everything after the header that A1111 uses for LoRAs.
+    """
+    full = hashlib.sha256()
+    legacy = hashlib.sha256()
+    addnet = None
+    buf = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        if path.lower().endswith('.safetensors'):
+            header = f.read(8)
+            addnet_start = 8 + struct.unpack('<Q', header)[0] if len(header) == 8 else 0
+            addnet = hashlib.sha256()
+            f.seek(0)
+        offset = 0
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            block = view[:n]
+            full.update(block)
+            lo, hi = max(0x100000 - offset, 0), min(0x110000 - offset, n)
+            if lo < hi:
+                legacy.update(block[lo:hi])
+            if addnet is not None and addnet_start < offset + n:
+                addnet.update(block[max(addnet_start - offset, 0):])
+            offset += n
+    sha256 = full.hexdigest()
+    return {
+        'sha256': sha256,
+        'autov2': sha256[:10],
+        'legacy': legacy.hexdigest()[:8],
+        'addnet': addnet.hexdigest() if addnet is not None else None,
+    }
+
+class ModelHashIndex:
+    """Persistent index of model hashes, keyed by (path, size, mtime).
+    
+    Files are only hashed again when their size or mtime changes, and names
+    are kept in a dict so lookups while filling metadata are O(1).
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.by_name = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+    
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        self._reindex()
+        self.loaded = True
+    
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+    
+    def _reindex(self):
+        by_name = {}
+        for path, entry in self.entries.items():
+            name = os.path.splitext(os.path.basename(path))[0].lower()
+            by_name[(entry['kind'], name)] = entry
+        self.by_name = by_name
+    
+    def scan(self, dirs, kind, workers=4):
+        """Hash new or changed model files below dirs; return how many were hashed"""
+        if not self.loaded:
+            self.load()
+        pending = []
+        seen = set()
+        for root in dirs:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    if not name.lower().endswith(MODEL_EXTENSIONS):
+                        continue
+                    path = os.path.abspath(os.path.join(dirpath, name))
+                    stat = os.stat(path)
+                    seen.add(path)
+                    entry = self.entries.get(path)
+                    if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                        pending.append((path, stat))
+        
+        def hash_one(item):
+            path, stat = item
+            return path, dict(hash_model_file(path), kind=kind, size=stat.st_size, mtime=stat.st_mtime)
+        
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(hash_one, pending))
+        
+        with self._lock:
+            roots = tuple(os.path.join(os.path.abspath(d), '') for d in dirs)
+            for path in [p for p, e in self.entries.items()
+                         if e['kind'] == kind and p.startswith(roots) and p not in seen]:
+                del self.entries[path]
+            self.entries.update(results)
+            self._reindex()
+        return len(results)
+    
+    def scan_configured(self, workers=4):
+        """Scan the model and LoRA directories from the environment"""
+        model_dirs, lora_dirs = env_dirs('CIVITAI_FIXER_MODEL_DIRS'), env_dirs('CIVITAI_FIXER_LORA_DIRS')
+        if not model_dirs and not lora_dirs:
+            # Nothing to scan, so leave the index file alone
+            return 0
+        hashed = self.scan(model_dirs, 'model', workers)
+        hashed += self.scan(lora_dirs, 'lora', workers)
+        if hashed or not os.path.exists(self.path):
+            self.save()
+        return hashed
+    
+    def get(self, name, kind='model'):
+        """Index entry for a model name (file name with or without extension)"""
+        if not self.loaded:
+            self.load()
+        name = name.strip().lower()
+        if name.endswith(MODEL_EXTENSIONS):
+            name = os.path.splitext(name)[0]
+        return self.by_name.get((kind, name))
+    
+    def lookup(self, name, kind='model'):
+        """AutoV2 hash for a model name, or None if it isn't indexed"""
+        entry = self.get(name, kind) if name else None
+        return entry['autov2'] if entry else None
+    
+    def lora_hashes(self, prompt):
+        """A1111 'Lora hashes' value for the <lora:...> tags in a prompt"""
+        parts = []
+        for name in dict.fromkeys(LORA_TAG_RE.findall(prompt)):
+            entry = self.get(name, 'lora')
+            if entry:
+                parts.append(f"{name}: {(entry['addnet'] or entry['sha256'])[:12]}")
+        return ', '.join(parts)
+
+model_index = ModelHashIndex(os.environ.get(
+    'CIVITAI_FIXER_HASH_INDEX',
+    os.path.join(os.path.expanduser('~'), '.cache', 'civitai_metadata_fixer', 'model_hashes.json')))
+
+@web.route('/model-hash')
+def model_hash():
+    from flask import jsonify, request
+    name = request.args.get('name', '')
+    kind = request.args.get('kind', 'model')
+    entry = model_index.get(name, kind)
+    if entry is None:
+        return jsonify({'error': f'{name!r} is not in the model index'}), 404
+    return jsonify({'name': name, 'hash': entry['autov2'], 'legacy': entry['legacy'], 'sha256': entry['sha256']})
+
+def run_hashes(args):
+    """Entry point of the `hashes` command"""
+    if args.index:
+        model_index.path = args.index
+    model_index.load()
+    start = time.monotonic()
+    hashed = model_index.scan(args.models or env_dirs('CIVITAI_FIXER_MODEL_DIRS'), 'model', args.workers)
+    hashed += model_index.scan(args.loras or env_dirs('CIVITAI_FIXER_LORA_DIRS'), 'lora', args.workers)
+    model_index.save()
+    for path, entry in sorted(model_index.entries.items()):
+        print(f"{entry['kind']:5} {entry['autov2']} {entry['legacy']} {path}")
+    print(f"Hashed {hashed} new or changed files in {time.monotonic() - start:.1f}s, "
+          f"{len(model_index.entries)} indexed")
+    return 0
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    prompt TEXT,
+    negative TEXT,
+    steps INTEGER,
+    sampler TEXT,
+    cfg REAL,
+    seed TEXT,
+    model TEXT,
+    model_hash TEXT,
+    parameters TEXT
+);
+CREATE INDEX IF NOT EXISTS images_sampler ON images (sampler);
+CREATE INDEX IF NOT EXISTS images_seed ON images (seed);
+CREATE INDEX IF NOT EXISTS images_model ON images (model);
+CREATE INDEX IF NOT EXISTS images_steps ON images (steps);
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5 (prompt, negative);
+CREATE TABLE IF NOT EXISTS content_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS content_hashes_sha256 ON content_hashes (sha256);
+CREATE TABLE IF NOT EXISTS check_results (
+    sha256 TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    detail TEXT NOT NULL
+);
+"""
+CATALOG_COLUMNS = ('path', 'size', 'mtime', 'width', 'height', 'prompt', 'negative', 'steps',
+                   'sampler', 'cfg', 'seed', 'model', 'model_hash', 'parameters')
+
+def default_catalog_path():
+    return os.environ.get('CIVITAI_FIXER_CATALOG', os.path.join(
+        os.path.expanduser('~'), '.cache', 'civitai_metadata_fixer', 'catalog.sqlite'))
+
+def open_catalog(path=None):
+    """Open (and create if needed) the SQLite metadata catalog"""
+    path = path or default_catalog_path()
+    if path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(CATALOG_SCHEMA)
+    return db
+
+def iter_image_stats(roots):
+    """Yield (path, size, mtime) of every supported image below roots, via scandir"""
+    stack = [os.path.abspath(root) for root in roots]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+def to_number(value, kind):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+def catalog_row(item):
+    """Pool worker: read and parse one image into a catalog row"""
+    path, size, mtime = item
+    try:
+        with open(path, 'rb') as fp:
+            meta = read_image_metadata(fp, PARAMETER_KEYS)
+    except Exception:
+        return (path, size, mtime) + (None,) * (len(CATALOG_COLUMNS) - 3)
+    params = image_parameters(meta['text']) or None
+    parsed = parse_a1111_params(params) if params else {}
+    return (path, size, mtime, meta['width'], meta['height'], parsed.get('prompt'), parsed.get('negative'),
+            to_number(parsed.get('steps'), int), parsed.get('sampler'), to_number(parsed.get('cfg'), float),
+            parsed.get('seed'), parsed.get('model'), parsed.get('model_hash'), params)
+
+def update_catalog(db, roots, workers=None, progress=print):
+    """Incrementally index the images below roots.
+    
+    Only files whose (path, size, mtime) changed are read, in a process pool;
+    rows for files that disappeared from the scanned directories are dropped.
+    Returns (added or changed, removed).
+    """
+    known = {row[0]: (row[1], row[2]) for row in db.execute('SELECT path, size, mtime FROM images')}
+    changed = []
+    seen = set()
+    for path, size, mtime in iter_image_stats(roots):
+        seen.add(path)
+        if known.get(path) != (size, mtime):
+            changed.append((path, size, mtime))
+    
+    prefixes = tuple(os.path.join(os.path.abspath(root), '') for root in roots)
+    removed = [path for path in known if path.startswith(prefixes) and path not in seen]
+    
+    insert = (f"INSERT INTO images ({', '.join(CATALOG_COLUMNS)}) VALUES ({', '.join('?' * len(CATALOG_COLUMNS))}) "
+              f"ON CONFLICT(path) DO UPDATE SET " + ', '.join(f'{c}=excluded.{c}' for c in CATALOG_COLUMNS[1:]))
+    with db:
+        for path in removed:
+            db.execute('DELETE FROM images_fts WHERE rowid = (SELECT rowid FROM images WHERE path = ?)', (path,))
+            db.execute('DELETE FROM images WHERE path = ?', (path,))
+    
+    if changed:
+        progress(f"Indexing {len(changed)} new or changed files ({len(known)} already indexed)")
+        pool = multiprocessing.Pool(workers) if len(changed) > 64 else None
+        rows = pool.imap_unordered(catalog_row, changed, chunksize=32) if pool else map(catalog_row, changed)
+        try:
+            with db:
+                for row in rows:
+                    rowid = db.execute(insert + ' RETURNING rowid', row).fetchone()[0]
+                    db.execute('DELETE FROM images_fts WHERE rowid = ?', (rowid,))
+                    db.execute('INSERT INTO images_fts (rowid, prompt, negative) VALUES (?, ?, ?)',
+                               (rowid, row[5] or '', row[6] or ''))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+    return len(changed), len(removed)
+
+def search_catalog(db, text=None, sampler=None, seed=None, model=None, steps=None, limit=100):
+    """Query the catalog; text is matched against prompts with FTS, the rest exactly"""
+    sql = 'SELECT images.* FROM images'
+    where, args = [], []
+    if text and text.strip():
+        sql += ' JOIN images_fts ON images_fts.rowid = images.rowid'
+        # Quote every term so user input can't break the FTS query syntax
+        where.append('images_fts MATCH ?')
+        args.append(' '.join('"%s"' % term.replace('"', '""') for term in text.split()))
+    for column, value in (('sampler', sampler), ('seed', seed), ('model', model), ('steps', steps)):
+        if value not in (None, ''):
+            where.append(f'images.{column} = ?')
+            args.append(int(value) if column == 'steps' else value)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY images.path LIMIT ?'
+    args.append(limit)
+    return [dict(row) for row in db.execute(sql, args)]
+
+@web.route('/search')
+def search():
+    from flask import jsonify, request
+    try:
+        limit = int(request.args.get('limit', 100))
+        steps = int(request.args['steps']) if request.args.get('steps') else None
+    except ValueError:
+        return jsonify({'error': 'limit and steps must be whole numbers'}), 400
+    db = open_catalog()
+    try:
+        results = search_catalog(db, request.args.get('q'), request.args.get('sampler'),
+                                 request.args.get('seed'), request.args.get('model'), steps, limit)
+    finally:
+        db.close()
+    return jsonify({'count': len(results), 'results': results})
+
+def run_index(args):
+    """Entry point of the `index` command"""
+    db = open_catalog(args.db)
+    start = time.monotonic()
+    changed, removed = update_catalog(db, args.dirs, args.workers)
+    total = db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+    db.close()
+    print(f"Indexed {changed} files, removed {removed}, {total} in catalog ({time.monotonic() - start:.1f}s)")
+    return 0
+
+def run_search(args):
+    """Entry point of the `search` command"""
+    db = open_catalog(args.db)
+    results = search_catalog(db, ' '.join(args.terms), args.sampler, args.seed, args.model, args.steps, args.limit)
+    db.close()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for row in results:
+            print(f"{row['path']}  [{row['sampler'] or '-'}, {row['steps'] or '-'} steps, seed {row['seed'] or '-'}, "
+                  f"{row['model'] or '-'}]")
+    return 0
+
+# Manifest columns that pick the file rather than set a value
+MATCH_COLUMNS = ('file', 'sha256')
+ROUND_TRIP_KEYS = ('prompt', 'negative', 'steps', 'sampler', 'cfg', 'seed', 'model', 'model_hash')
+
+def hash_image_file(item):
+    """Pool worker: (path, size, mtime) -> (path, size, mtime, sha256 of the content)"""
+    path, size, mtime = item
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return path, size, mtime, digest.hexdigest()
+
+def content_hashes(db, files, workers):
+    """sha256 -> [path] for (path, size, mtime) files, rehashing only new or changed ones"""
+    cached = {row['path']: row for row in db.execute('SELECT * FROM content_hashes')}
+    by_hash = {}
+    stale = []
+    for path, size, mtime in files:
+        row = cached.get(path)
+        if row and row['size'] == size and row['mtime'] == mtime:
+            by_hash.setdefault(row['sha256'], []).append(path)
+        else:
+            stale.append((path, size, mtime))
+    if stale:
+        with multiprocessing.Pool(workers) as pool:
+            hashed = list(pool.imap_unordered(hash_image_file, stale, chunksize=16))
+        with db:
+            db.executemany('INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?, ?)', hashed)
+        for path, size, mtime, sha256 in hashed:
+            by_hash.setdefault(sha256, []).append(path)
+    return by_hash
+
+def match_manifest(rows, files, db=None, workers=1):
+    """Assign manifest rows to files: {path: row}, the rows that matched nothing
+    and (row, paths) for rows whose file name is ambiguous.
+    
+    files are (path, root, size, mtime). Rows match by relative path or file
+    name through dict lookups, by 'sha256' through the catalog's content hash
+    index, or by a glob in 'file'; the first of these to match a file wins.
+    A file name shared by several files in the tree (every 00001.png of
+    different output folders) matches none of them; those rows need a
+    relative path instead.
+    """
+    by_rel = {}
+    by_name = {}
+    rels = []
+    for path, root, size, mtime in files:
+        rel = os.path.relpath(path, root).replace(os.sep, '/')
+        by_rel[rel] = path
+        by_name.setdefault(os.path.basename(path), []).append(path)
+        rels.append((rel, path))
+    
+    assigned = {}
+    unmatched = []
+    ambiguous = []
+    globs = []
+    hashed = []
+    for row in rows:
+        name = row.get('file', '').replace('\\', '/')
+        if name and any(c in name for c in '*?['):
+            globs.append((name, row))
+            continue
+        if name in by_rel:
+            paths = [by_rel[name]]
+        elif name:
+            paths = by_name.get(os.path.basename(name), [])
+            if len(paths) > 1:
+                ambiguous.append((row, paths))
+                continue
+        elif row.get('sha256'):
+            hashed.append(row)
+            continue
+        else:
+            paths = []
+        for path in paths:
+            assigned.setdefault(path, row)
+        if not paths:
+            unmatched.append(row)
+    
+    if hashed:
+        index = content_hashes(db, [(path, size, mtime) for path, root, size, mtime in files], workers)
+        for row in hashed:
+            paths = index.get(row['sha256'].lower(), [])
+            for path in paths:
+                assigned.setdefault(path, row)
+            if not paths:
+                unmatched.append(row)
+    
+    if globs:
+        # Each glob is only tested against the names sharing its literal prefix,
+        # found by bisecting the sorted names, so the cost follows the matches
+        # rather than globs times files
+        found = set()
+        for with_dir in (True, False):
+            group = [(i, pattern) for i, (pattern, row) in enumerate(globs) if ('/' in pattern) == with_dir]
+            if not group:
+                continue
+            names = sorted(rels if with_dir else ((os.path.basename(path), path) for rel, path in rels))
+            for i, pattern in group:
+                prefix = re.split(r'[*?[]', pattern, 1)[0]
+                match = re.compile(fnmatch.translate(pattern)).match
+                for k in range(bisect.bisect_left(names, (prefix,)), len(names)):
+                    name, path = names[k]
+                    if not name.startswith(prefix):
+                        break
+                    if path not in assigned and match(name):
+                        assigned[path] = globs[i][1]
+                        found.add(i)
+        unmatched.extend(row for i, (pattern, row) in enumerate(globs) if i not in found)
+    return assigned, unmatched, ambiguous
+
+def round_trip_error(parameters, values):
+    """Why parameters don't parse back to the values they were built from, or None"""
+    if not has_valid_parameters(parameters):
+        return 'no Steps/Sampler settings'
+    if 'parameters' in values:
+        return None
+    parsed = parse_a1111_params(parameters)
+    for key in ROUND_TRIP_KEYS:
+        wanted = values.get(key, '').strip()
+        if wanted and not (key == 'seed' and wanted == '-1') and parsed.get(key, '').strip() != wanted:
+            return f"{key} reads back as {parsed.get(key)!r} instead of {wanted!r}"
+    return None
+
+def apply_one(task):
+    """Pool worker: write one manifest row into a file and return (src, status, bytes read)"""
+    src, dst, values, dry_run = task
+    try:
+        size = os.path.getsize(src)
+        with open(src, 'rb') as fp:
+            head = peek_signature(fp)
+            meta = read_image_metadata(fp, PARAMETER_KEYS)
+        parameters = parameters_for(meta, values)
+        problem = round_trip_error(parameters, values)
+        if problem:
+            return src, f'error: {problem}', 0
+        if not dry_run:
+            write_fixed_file(src, fixed_name(dst, head, parameters), parameters)
+        return src, 'fixed', size
+    except Exception as e:
+        return src, f'error: {e}', 0
+
+def run_apply(args):
+    """Entry point of the `apply` command: write manifest rows into matching images"""
+    with open(args.manifest, encoding='utf-8-sig') as f:
+        rows = manifest_rows(f.read(), args.manifest.lower())
+    roots = [os.path.abspath(d) for d in args.dirs]
+    files = []
+    for root in roots:
+        files.extend((path, root, size, mtime) for path, size, mtime in iter_image_stats([root])
+                     if '_civitai.' not in os.path.basename(path))
+    
+    start = time.monotonic()
+    db = open_catalog(args.db) if any('sha256' in row for row in rows) else None
+    assigned, unmatched, ambiguous = match_manifest(rows, files, db, args.workers)
+    print(f"{len(rows)} manifest rows matched {len(assigned)} of {len(files)} files "
+          f"in {time.monotonic() - start:.1f}s, {len(unmatched)} rows matched nothing, "
+          f"{len(ambiguous)} skipped as ambiguous")
+    for row in unmatched[:20]:
+        print(f"  no match: {row.get('file') or row.get('sha256')}", file=sys.stderr)
+    for row, paths in ambiguous[:20]:
+        print(f"  ambiguous: {row['file']} is the name of {len(paths)} files, "
+              f"give a path relative to the folder instead", file=sys.stderr)
+    
+    root_of = {path: root for path, root, size, mtime in files}
+    tasks = []
+    for path, row in assigned.items():
+        values = {k: v for k, v in row.items() if k not in MATCH_COLUMNS}
+        out_dir = args.out
+        if out_dir is not None and len(roots) > 1:
+            out_dir = os.path.join(out_dir, os.path.basename(root_of[path]))
+        tasks.append((path, fixed_path(path, root_of[path], out_dir), values, args.dry_run))
+    
+    model_index.scan_configured()
+    counts = run_tasks(apply_one, tasks, args.workers, chunksize=64)
+    if args.dry_run:
+        print("Dry run, no files were written")
+    return 1 if counts['error'] else 0
+
+# What `check` reports, from best to worst
+CHECK_STATUSES = ('valid', 'missing_keys', 'malformed', 'comfyui_only', 'missing', 'unreadable')
+CHECK_RECOMMENDED_KEYS = ('CFG scale', 'Seed', 'Size', 'Model')
+# Bump when classify_metadata() changes, so cached results are redone
+CHECK_VERSION = 1
+
+def classify_metadata(text):
+    """(status, detail) for an image's text metadata, as Civitai's detection would see it"""
+    params = text.get('parameters', '')
+    if not params.strip():
+        if 'prompt' in text or 'workflow' in text:
+            return 'comfyui_only', 'ComfyUI graph but no A1111 parameters'
+        return 'missing', 'no parameters'
+    prompt, negative, settings = split_a1111_params(params)
+    if not settings:
+        last_line = params.strip().rpartition('\n')[2]
+        return 'malformed', f"no readable settings line (last line: {last_line[:80]!r})"
+    missing = [key for key in ('Steps', 'Sampler') if key not in settings]
+    if missing:
+        return 'missing_keys', f"settings line lacks {', '.join(missing)}"
+    absent = [key for key in CHECK_RECOMMENDED_KEYS if key not in settings]
+    return 'valid', f"no {', '.join(absent)}" if absent else ''
+
+def check_stream(fp):
+    """(status, detail) for an open image, reading only its metadata"""
+    try:
+        meta = read_image_metadata(fp, PARAMETER_KEYS)
+    except ValueError as e:
+        return 'unreadable', str(e)
+    except Exception:
+        # Pillow's messages name the file object; results are cached by content
+        return 'unreadable', 'not a readable image'
+    return classify_metadata(meta['text'])
+
+def check_file(item):
+    """Pool worker: (path, size, mtime) -> (path, size, mtime, sha256, status, detail)"""
+    path, size, mtime = item
+    try:
+        with open(path, 'rb') as fp:
+            status, detail = check_stream(fp)
+            fp.seek(0)
+            digest = hashlib.sha256()
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(block)
+    except OSError as e:
+        return path, size, mtime, None, 'unreadable', str(e)
+    return path, size, mtime, digest.hexdigest(), status, detail
+
+def check_files(db, files, workers):
+    """Check (path, size, mtime) files and return {path: (status, detail)}.
+    
+    Results are cached by content hash. An unchanged file (same size and mtime)
+    is answered from the catalog without opening it, and a renamed or copied
+    file is hashed but not parsed again.
+    """
+    hashes = {row['path']: row for row in db.execute('SELECT * FROM content_hashes')}
+    results = {row['sha256']: (row['status'], row['detail'])
+               for row in db.execute('SELECT * FROM check_results WHERE version = ?', (CHECK_VERSION,))}
+    report = {}
+    todo = []
+    for path, size, mtime in files:
+        row = hashes.get(path)
+        if row and row['size'] == size and row['mtime'] == mtime and row['sha256'] in results:
+            report[path] = results[row['sha256']]
+        else:
+            todo.append((path, size, mtime))
+    if not todo:
+        return report
+    
+    with multiprocessing.Pool(workers) as pool:
+        checked = list(pool.imap_unordered(check_file, todo, chunksize=16))
+    with db:
+        db.executemany('INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?, ?)',
+                       [row[:4] for row in checked if row[3]])
+        db.executemany('INSERT OR REPLACE INTO check_results VALUES (?, ?, ?, ?)',
+                       [(sha256, CHECK_VERSION, status, detail)
+                        for path, size, mtime, sha256, status, detail in checked if sha256])
+    for path, size, mtime, sha256, status, detail in checked:
+        # A copy of an already checked file keeps the cached verdict
+        report[path] = results.get(sha256) or (status, detail)
+    return report
+
+def check_summary(statuses):
+    return {status: statuses.count(status) for status in CHECK_STATUSES}
+
+def run_check(args):
+    """Entry point of the `check` command: report which images Civitai will read"""
+    files = list(iter_image_stats(args.dirs))
+    files = [item for item in files if '_civitai.' not in os.path.basename(item[0])]
+    start = time.monotonic()
+    db = open_catalog(':memory:' if args.no_cache else args.db)
+    report = check_files(db, files, args.workers)
+    db.close()
+    
+    entries = [{'path': path, 'status': status, 'detail': detail}
+               for path, (status, detail) in sorted(report.items())]
+    summary = check_summary([entry['status'] for entry in entries])
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'files': entries}, f, indent=1)
+    for entry in entries:
+        if entry['status'] != 'valid':
+            print(f"{entry['status']:13} {entry['path']}  ({entry['detail']})")
+    print(f"Checked {len(entries)} files in {time.monotonic() - start:.1f}s: "
+          + ', '.join(f"{count} {status}" for status, count in summary.items() if count))
+    return 0 if summary['valid'] == len(entries) else 1
+
+@web.route('/check', methods=['POST'])
+def check():
+    """Classify uploaded images without changing them.
+    
+    Takes the same bodies as /batch (a ZIP, an 'archive' form file or 'image'
+    form files) or a single raw image, and returns a JSON report.
+    """
+    from flask import jsonify, request
+    owned = []
+    if request.mimetype == 'multipart/form-data':
+        if 'archive' in request.files:
+            body = take_upload(request.files['archive'])
+        else:
+            files = [(upload.filename, take_upload(upload)) for upload in request.files.getlist('image')]
+            owned.extend(fp for _, fp in files)
+            body = None
+    else:
+        body = tempfile.TemporaryFile()
+        for block in iter(lambda: request.stream.read(STREAM_BLOCK_SIZE), b''):
+            body.write(block)
+        body.seek(0)
+    
+    try:
+        if body is not None:
+            owned.append(body)
+            if image_format(peek_signature(body)):
+                files = [(request.args.get('name', 'image'), body)]
+                entries = upload_entries(files)
+            else:
+                try:
+                    entries = zip_entries(zipfile.ZipFile(body))
+                except zipfile.BadZipFile:
+                    return jsonify({'error': 'The body is neither an image nor a ZIP archive'}), 400
+        else:
+            entries = upload_entries(files)
+        
+        report = []
+        for name, open_entry, size in entries:
+            with open_entry() as fp:
+                status, detail = check_stream(fp)
+            report.append({'file': name, 'status': status, 'detail': detail})
+    finally:
+        for fp in owned:
+            fp.close()
+    return jsonify({'summary': check_summary([entry['status'] for entry in report]), 'files': report})
+
+class ServiceBusy(Exception):
+    """Raised when the server has no capacity left for another request"""
+
+class BoundedExecutor:
+    """Thread pool with a fixed number of running plus queued tasks.
+    
+    Pillow releases the GIL while encoding and decoding, so threads spread the
+    CPU-heavy work over cores; once every slot is taken new work is refused
+    with ServiceBusy instead of piling up in an unbounded queue.
+    """
+    
+    def __init__(self, workers, queue_size):
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+    
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            raise ServiceBusy()
+        try:
+            return self.pool.submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+# Only set up by `serve`; the desktop app and CLI run everything inline
+cpu_executor = None
+request_slots = None
+RETRY_AFTER_SECONDS = 1
+
+def run_cpu_bound(func, *args):
+    """Run func on the bounded executor in serve mode, inline otherwise"""
+    if cpu_executor is None:
+        return func(*args)
+    return cpu_executor.run(func, *args)
+
+@web.errorhandler(ServiceBusy)
+def service_busy(e):
+    from flask import jsonify
+    response = jsonify({'error': 'Server is busy, please retry shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+    return response
+
+@web.before_request
+def acquire_request_slot():
+    from flask import request
+    if request_slots is not None:
+        if not request_slots.acquire(blocking=False):
+            raise ServiceBusy()
+        request.environ['civitai_fixer.slot'] = True
+
+@web.after_request
+def hold_request_slot(response):
+    # Teardown runs before a streamed body is sent, so keep the slot until
+    # the server closes the response
+    from flask import request
+    if request.environ.pop('civitai_fixer.slot', False):
+        response.call_on_close(request_slots.release)
+    return response
+
+@web.teardown_request
+def release_request_slot(exc):
+    # Only reached with the slot still held if no response was made
+    from flask import request
+    if request.environ.pop('civitai_fixer.slot', False):
+        request_slots.release()
+
+def serve_worker(sock, threads):
+    """Serve requests on an inherited listening socket in this process"""
+    from werkzeug.serving import make_server
+    global request_slots
+    request_slots = threading.BoundedSemaphore(threads)
+    server = make_server(*sock.getsockname()[:2], get_app(), threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+def run_serve(args):
+    """Entry point of the `serve` command: pre-forked production server"""
+    global cpu_executor, RETRY_AFTER_SECONDS, metrics_enabled, profiling_enabled
+    global png_threads, png_level, png_filter
+    get_app().config['MAX_CONTENT_LENGTH'] = args.max_body_mb * 1024 * 1024
+    png_threads = args.png_threads or png_threads
+    png_level = args.png_level if args.png_level is not None else png_level
+    png_filter = args.png_filter or png_filter
+    RETRY_AFTER_SECONDS = args.retry_after
+    metrics_enabled = metrics_enabled or args.metrics
+    profiling_enabled = profiling_enabled or args.profiling
+    cpu_executor = BoundedExecutor(args.cpu_workers, args.queue)
+    model_index.scan_configured()
+    
+    sock = socket.socket(socket.AF_INET6 if ':' in args.host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} worker processes, "
+          f"{args.threads} requests and {args.cpu_workers} encoders each")
+    
+    if args.workers <= 1 or not hasattr(os, 'fork'):
+        serve_worker(sock, args.threads)
+        return 0
+    
+    children = set()
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # The executor's threads don't survive fork, so every worker gets its own
+            global cpu_executor
+            cpu_executor = BoundedExecutor(args.cpu_workers, args.queue)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                serve_worker(sock, args.threads)
+            finally:
+                os._exit(0)
+        children.add(pid)
+    
+    def stop(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    for _ in range(args.workers):
+        spawn()
+    while True:
+        # Replace workers that crash
+        pid, status = os.wait()
+        children.discard(pid)
+        print(f"Worker {pid} exited with status {status}, restarting", file=sys.stderr)
+        spawn()
 
 def open_browser():
+    import webbrowser
     webbrowser.open('http://127.0.0.1:5000')
 
-if __name__ == '__main__':
+def run_app():
     print("\n" + "="*50)
     print("🖼️  Civitai Metadata Fixer")
     print("="*50)
     print("\n📌 Opening browser at http://127.0.0.1:5000")
     print("   Press Ctrl+C to stop the server\n")
     
+    # Hash new models in the background; lookups see them once it's done
+    threading.Thread(target=model_index.scan_configured, daemon=True).start()
     Timer(1.5, open_browser).start()
-    app.run(debug=False, port=5000)
+    get_app().run(debug=False, port=5000)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--library', metavar='DIR',
+                        help='let the web UI open and save images below DIR by path (default: $CIVITAI_FIXER_LIBRARY)')
+    commands = parser.add_subparsers(dest='command')
+    
+    fix = commands.add_parser('fix', help='add valid metadata to every image in directories')
+    fix.add_argument('dirs', nargs='+', metavar='DIR', help='directories (or files) to fix')
+    fix.add_argument('-o', '--out', help='write fixed files to a mirror tree instead of in place')
+    fix.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                     help='number of worker processes (default: CPU count)')
+    fix.add_argument('--journal', help='record finished files here and skip them on the next run')
+    fix.add_argument('--force', action='store_true', help='rewrite files that already have valid parameters')
+    fix.set_defaults(func=run_fix)
+    
+    hashes = commands.add_parser('hashes', help='hash model and LoRA files into the model index')
+    hashes.add_argument('--models', nargs='+', metavar='DIR',
+                        help='checkpoint directories (default: $CIVITAI_FIXER_MODEL_DIRS)')
+    hashes.add_argument('--loras', nargs='+', metavar='DIR',
+                        help='LoRA directories (default: $CIVITAI_FIXER_LORA_DIRS)')
+    hashes.add_argument('--index', help='index file (default: $CIVITAI_FIXER_HASH_INDEX)')
+    hashes.add_argument('-j', '--workers', type=int, default=4, help='hashing threads')
+    hashes.set_defaults(func=run_hashes)
+    
+    serve = commands.add_parser('serve', help='run a multi-process server for shared deployments')
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--port', type=int, default=5000)
+    serve.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    serve.add_argument('--threads', type=int, default=16, help='concurrent requests per worker')
+    serve.add_argument('--cpu-workers', type=int, default=2, help='concurrent encodes/decodes per worker')
+    serve.add_argument('--queue', type=int, default=4, help='encodes allowed to wait per worker')
+    serve.add_argument('--max-body-mb', type=int, default=100, help='largest accepted request body')
+    serve.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds on 503')
+    serve.add_argument('--png-threads', type=int,
+                       help='threads compressing each re-encoded PNG, 1 for Pillow (default: $CIVITAI_FIXER_PNG_THREADS or CPU count)')
+    serve.add_argument('--png-level', type=int, choices=range(10), metavar='0-9',
+                       help='zlib level for re-encoded PNGs (default: $CIVITAI_FIXER_PNG_LEVEL or 6)')
+    serve.add_argument('--png-filter', choices=PNG_FILTERS,
+                       help='row filter for re-encoded PNGs (default: $CIVITAI_FIXER_PNG_FILTER or up)')
+    serve.add_argument('--metrics', action='store_true', help='record timings for /metrics')
+    serve.add_argument('--profiling', action='store_true', help='allow ?profile=1 sampling profiles')
+    serve.set_defaults(func=run_serve)
+    
+    index = commands.add_parser('index', help='add images to the searchable metadata catalog')
+    index.add_argument('dirs', nargs='+', metavar='DIR', help='directories to index')
+    index.add_argument('--db', help='catalog file (default: $CIVITAI_FIXER_CATALOG)')
+    index.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='parser processes')
+    index.set_defaults(func=run_index)
+    
+    search = commands.add_parser('search', help='query the metadata catalog')
+    search.add_argument('terms', nargs='*', help='words to look for in prompts')
+    search.add_argument('--sampler')
+    search.add_argument('--seed')
+    search.add_argument('--model')
+    search.add_argument('--steps', type=int)
+    search.add_argument('--limit', type=int, default=100)
+    search.add_argument('--db', help='catalog file (default: $CIVITAI_FIXER_CATALOG)')
+    search.add_argument('--json', action='store_true', help='print results as JSON')
+    search.set_defaults(func=run_search)
+    
+    apply = commands.add_parser('apply', help='write metadata from a CSV/JSONL/JSON manifest into images')
+    apply.add_argument('manifest', help='manifest; rows pick files by "file" (name, path or glob) or "sha256"')
+    apply.add_argument('dirs', nargs='+', metavar='DIR', help='directories holding the images')
+    apply.add_argument('-o', '--out', help='write fixed files to a mirror tree instead of in place')
+    apply.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    apply.add_argument('--db', help='catalog holding the content hash index (default: $CIVITAI_FIXER_CATALOG)')
+    apply.add_argument('--dry-run', action='store_true', help='match and validate, but write nothing')
+    apply.set_defaults(func=run_apply)
+    
+    check = commands.add_parser('check', help='report which images have metadata Civitai can read')
+    check.add_argument('dirs', nargs='+', metavar='DIR', help='directories to check')
+    check.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    check.add_argument('--report', help='write a JSON report here')
+    check.add_argument('--db', help='catalog holding cached results (default: $CIVITAI_FIXER_CATALOG)')
+    check.add_argument('--no-cache', action='store_true', help='check every file again')
+    check.set_defaults(func=run_check)
+    
+    watch = commands.add_parser('watch', help='keep fixing new images as they appear in directories')
+    watch.add_argument('dirs', nargs='+', metavar='DIR', help='directories to watch')
+    watch.add_argument('-o', '--out', help='write fixed files to a mirror tree instead of in place')
+    watch.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    watch.add_argument('--queue', type=int, default=256, help='files allowed to wait for a worker')
+    watch.add_argument('--settle', type=float, default=0.5,
+                       help='seconds a file must stay unchanged before it is fixed')
+    watch.add_argument('--poll', action='store_true', help='poll instead of using inotify (network shares)')
+    watch.add_argument('--interval', type=float, default=2, help='seconds between polls')
+    watch.add_argument('--state', help='file remembering handled images (default: $CIVITAI_FIXER_WATCH_STATE)')
+    watch.add_argument('--force', action='store_true', help='rewrite files that already have valid parameters')
+    watch.set_defaults(func=run_watch)
+    
+    args = parser.parse_args(argv)
+    if args.library:
+        if not os.path.isdir(args.library):
+            parser.error(f"--library: {args.library} is not a directory")
+        configure_library(args.library)
+    if args.command is None:
+        return run_app()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())